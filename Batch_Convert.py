@@ -0,0 +1,377 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# Converts a folder of sod files to one .blend file per ship with a pool of
+# background blender processes. Runs with any python 3, blender is only
+# needed for the workers and does not need a gpu or a display:
+#
+#   python Batch_Convert.py --blender /path/to/blender --output /path/to/blends
+#       [--jobs 4] [--batch-size 8] [--textures /path/to/textures]
+#       [--asset-catalog "Star Trek Armada/Ships"] sod files or folders...
+#
+# Every worker imports the addon once and then converts a batch of files, so
+# blender only starts up once per batch. Failed files are listed in
+# errors.log in the output folder.
+#
+# The other way around, every scene and collection with a root object of a
+# .blend file is exported to its own sod file:
+#
+#   blender -b --factory-startup faction.blend --python Batch_Convert.py --
+#       --export --output /path/to/sod [--version 1.8|1.93|BOTH]
+#       [--package /path/to/mod]
+#
+# With --package the sod files and every texture they use are copied into the
+# sod and textures folders of a mod, only if they changed since the last
+# time. Works on its own without blender as well:
+#
+#   python Batch_Convert.py --package /path/to/mod [--textures /path/to/textures]
+#       sod files or folders...
+
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+ADDON_PATH = os.path.dirname(os.path.abspath(__file__))
+ADDON_NAME = "".join(c if c.isalnum() else "_" for c in os.path.basename(ADDON_PATH))
+ERROR_LOG = "errors.log"
+
+
+def get_sod_files(paths):
+    sod_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, files in os.walk(path):
+                sod_files.extend(os.path.join(folder, file_name)
+                                 for file_name in sorted(files)
+                                 if file_name.lower().endswith(".sod"))
+        else:
+            sod_files.append(path)
+    return [os.path.abspath(file_path).replace("\\", "/") for file_path in sod_files]
+
+
+def get_catalog_id(library_path, catalog):
+    # Same catalog file handling as the fill asset library operator
+    cats_f = "{}/blender_assets.cats.txt".format(library_path)
+    if os.path.isfile(cats_f):
+        with open(cats_f, "r") as f:
+            for line in f.readlines():
+                if line.startswith(("#", "VERSION", "\n")):
+                    continue
+                c_uuid, path, name = line.split(":")
+                if path == catalog:
+                    return c_uuid
+        add_version_to_cats = False
+    else:
+        add_version_to_cats = True
+
+    c_uuid = str(uuid.uuid4())
+    with open(cats_f, "a+") as f:
+        if add_version_to_cats:
+            f.write("VERSION 1\n")
+        f.write(":".join((c_uuid, catalog, catalog.split("/")[-1])))
+        f.write("\n")
+    return c_uuid
+
+
+def import_module(name):
+    # Addon modules that don't need blender, without running the __init__ of
+    # the addon when it isn't loaded
+    if ADDON_NAME not in sys.modules:
+        package = types.ModuleType(ADDON_NAME)
+        package.__path__ = [ADDON_PATH]
+        sys.modules[ADDON_NAME] = package
+    return importlib.import_module(ADDON_NAME + "." + name)
+
+
+def run_package(args, sod_files):
+    if not sod_files:
+        print("No sod files to package")
+        return 1
+    SOD_Package = import_module("SOD_Package")
+    result = SOD_Package.package_mod(sod_files, args.package, args.textures)
+    for name in result["copied_sod"] + result["copied_textures"]:
+        print("Copied", name)
+    for name in result["missing_textures"]:
+        print("Texture not found:", name)
+    print("Copied {} of {} sod files and {} of {} textures to {}".format(
+        len(result["copied_sod"]), result["sod"], len(result["copied_textures"]),
+        result["textures"], args.package))
+    return 0
+
+
+# ------------------------------------------------------------------------
+#    worker, runs inside blender
+# ------------------------------------------------------------------------
+def load_addon():
+    import bpy
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(
+        ADDON_NAME, os.path.join(ADDON_PATH, "__init__.py"),
+        submodule_search_locations=[ADDON_PATH])
+    addon = importlib.util.module_from_spec(spec)
+    sys.modules[ADDON_NAME] = addon
+    spec.loader.exec_module(addon)
+    addon.register()
+    # Makes the addon preferences available, factory startup has none
+    bpy.context.preferences.addons.new().module = ADDON_NAME
+    return addon
+
+
+def clear_data():
+    import bpy
+    for name in ("objects", "collections", "meshes", "materials", "actions", "images", "node_groups"):
+        bpy.data.batch_remove(list(getattr(bpy.data, name)))
+    bpy.context.scene.frame_end = 1
+
+
+def convert_sod(file_path, output_path, catalog_id):
+    import bpy
+    SOD = sys.modules[ADDON_NAME + ".SOD"].SOD
+    Blender_SOD = sys.modules[ADDON_NAME + ".Blender_SOD"]
+    Blender_Materials = sys.modules[ADDON_NAME + ".Blender_Materials"]
+    UI = sys.modules[ADDON_NAME + ".UI"]
+
+    ship_name = os.path.splitext(os.path.basename(file_path))[0]
+    clear_data()
+    sod = SOD.from_file_path(file_path)
+
+    # Imported objects end up in the active collection
+    scene = bpy.context.scene
+    collection = bpy.data.collections.new(ship_name)
+    scene.collection.children.link(collection)
+    view_layer = bpy.context.view_layer
+    view_layer.active_layer_collection = view_layer.layer_collection.children[collection.name]
+    scene.sta_sod_file_path = file_path
+
+    mesh_objects = Blender_SOD.Import_SOD(sod)
+    texture_path = UI.guess_texture_path(file_path.lower())
+    Blender_Materials.finsh_object_materials(mesh_objects, texture_path, sod.materials)
+
+    if catalog_id is not None:
+        collection.asset_mark()
+        collection.asset_data.catalog_id = catalog_id
+
+    blend_path = os.path.join(output_path, ship_name + ".blend")
+    bpy.ops.wm.save_as_mainfile(filepath=blend_path, check_existing=False, compress=True)
+    return blend_path
+
+
+def run_worker(args):
+    import bpy
+    import traceback
+    load_addon()
+    if args.textures:
+        bpy.context.preferences.addons[ADDON_NAME].preferences.default_image_path = args.textures
+
+    with open(args.results, "a") as results:
+        for file_path in args.files:
+            start = time.perf_counter()
+            result = {"file": file_path}
+            try:
+                result["blend"] = convert_sod(file_path, args.output, args.catalog_id)
+            except Exception:
+                result["error"] = traceback.format_exc()
+            result["seconds"] = time.perf_counter() - start
+            results.write(json.dumps(result) + "\n")
+            results.flush()
+
+
+def run_export(args):
+    load_addon()
+    Blender_SOD = sys.modules[ADDON_NAME + ".Blender_SOD"]
+    UI = sys.modules[ADDON_NAME + ".UI"]
+
+    exports = Blender_SOD.Get_batch_exports()
+    if not exports:
+        print("No scene or collection with a 'root' or 'Scene Root' object found")
+        return 1
+    os.makedirs(args.output, exist_ok=True)
+    options = Blender_SOD.Export_options(
+        optimize_vertex_cache=args.optimize_vertex_cache,
+        renumber_vertices=args.renumber_vertices,
+        weld_vertices=args.weld_vertices,
+        merge_children=args.merge_children,
+        splice=args.splice)
+    batch = [(scene, root, UI.get_batch_targets(args.output, name, args.version, args.armada2_suffix))
+             for name, scene, root in exports]
+
+    start = time.perf_counter()
+    errors = Blender_SOD.Export_SOD_batch(batch, options)
+    wall_time = time.perf_counter() - start
+    for (name, _, _), error in zip(exports, errors):
+        if error is None:
+            print("Exported", name)
+        else:
+            print("Failed {}: {}".format(name, error))
+    print("Exported {} of {} ships in {:.1f}s".format(errors.count(None), len(exports), wall_time))
+    for phase, seconds in options.stats.get("timings", {}).items():
+        print("{:<12} {:.3f}s".format(phase, seconds))
+    if args.package:
+        run_package(args, [file_path for (_, _, targets), error in zip(batch, errors)
+                           if error is None for file_path, _ in targets])
+    return 0 if errors.count(None) == len(errors) else 1
+
+
+# ------------------------------------------------------------------------
+#    driver, launches the workers
+# ------------------------------------------------------------------------
+def run_batch(args, batch, catalog_id):
+    fd, results_path = tempfile.mkstemp(suffix=".jsonl", prefix="sta_batch_")
+    os.close(fd)
+    command = [args.blender, "-b", "--factory-startup", "--python", os.path.abspath(__file__),
+               "--", "--worker", "--results", results_path, "--output", args.output]
+    if args.textures:
+        command += ["--textures", args.textures]
+    if catalog_id is not None:
+        command += ["--catalog-id", catalog_id]
+    command += batch
+
+    try:
+        process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                 text=True, errors="replace")
+        with open(results_path, "r") as f:
+            results = [json.loads(line) for line in f if line.strip()]
+    finally:
+        os.remove(results_path)
+
+    # Files the worker never got to, most likely blender crashed on the
+    # file after the last result
+    done = set(result["file"] for result in results)
+    for file_path in batch:
+        if file_path not in done:
+            results.append({"file": file_path, "seconds": 0.0, "error":
+                            "Blender exited with code {} before converting this file\n{}".format(
+                                process.returncode, process.stderr[-2000:])})
+    return results
+
+
+def run_driver(args):
+    sod_files = get_sod_files(args.files)
+    if not sod_files:
+        print("No sod files found")
+        return 1
+    os.makedirs(args.output, exist_ok=True)
+    catalog_id = None
+    if args.asset_catalog:
+        catalog_id = get_catalog_id(args.output, args.asset_catalog)
+
+    jobs = max(1, args.jobs)
+    batches = [sod_files[i:i + args.batch_size] for i in range(0, len(sod_files), args.batch_size)]
+    print("Converting {} sod files with {} blender processes".format(len(sod_files), jobs))
+
+    start = time.perf_counter()
+    results = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for batch_results in executor.map(lambda batch: run_batch(args, batch, catalog_id), batches):
+            for result in batch_results:
+                if "error" in result:
+                    print("Failed {}".format(result["file"]))
+                else:
+                    print("Converted {} in {:.2f}s".format(result["file"], result["seconds"]))
+            results.extend(batch_results)
+    wall_time = time.perf_counter() - start
+
+    failed = [result for result in results if "error" in result]
+    error_log = os.path.join(args.output, ERROR_LOG)
+    if failed:
+        with open(error_log, "w") as f:
+            for result in failed:
+                f.write("{}\n{}\n".format(result["file"], result["error"].rstrip()))
+                f.write("\n")
+    elif os.path.isfile(error_log):
+        os.remove(error_log)
+
+    converted = len(results) - len(failed)
+    input_size = sum(os.path.getsize(file_path) for file_path in sod_files if os.path.isfile(file_path))
+    convert_time = sum(result["seconds"] for result in results)
+    print("Converted {} of {} files, {} failed".format(converted, len(results), len(failed)))
+    print("Wall time {:.1f}s, {:.1f} files/min, {:.2f} MB/s of sod data".format(
+        wall_time, len(results) * 60.0 / max(wall_time, 1e-6),
+        input_size / 1048576.0 / max(wall_time, 1e-6)))
+    print("Average {:.2f}s per file in blender".format(convert_time / len(results)))
+    if failed:
+        print("Errors written to {}".format(error_log))
+    return 1 if failed else 0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Convert sod files to .blend files with background blender processes")
+    parser.add_argument("files", nargs="*", help="Sod files or folders with sod files")
+    parser.add_argument("--output", default="", help="Folder for the .blend files or exported sod files")
+    parser.add_argument("--blender", default="blender", help="Blender executable")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1,
+                        help="Number of blender processes")
+    parser.add_argument("--batch-size", type=int, default=8,
+                        help="Number of files converted by one blender process")
+    parser.add_argument("--textures", default="",
+                        help="Texture folder for sod files that are not in a sod folder next to a textures folder")
+    parser.add_argument("--asset-catalog", default="",
+                        help="Mark every ship as an asset in this catalog, e.g. \"Star Trek Armada/Ships\"")
+    parser.add_argument("--export", action="store_true",
+                        help="Export the ships of the open .blend file instead, runs inside blender")
+    parser.add_argument("--version", choices=("1.8", "1.93", "BOTH"), default="1.8",
+                        help="Sod version of the exported files")
+    parser.add_argument("--armada2-suffix", default="_a2",
+                        help="Added to the file name of the Armada II copy when exporting for both games")
+    parser.add_argument("--optimize-vertex-cache", action="store_true",
+                        help="Reorder the faces of exported meshes for better vertex cache reuse")
+    parser.add_argument("--renumber-vertices", action="store_true",
+                        help="Reorder vertices of exported meshes by their first use")
+    parser.add_argument("--weld-vertices", action="store_true",
+                        help="Merge nearby vertices of exported meshes")
+    parser.add_argument("--merge-children", action="store_true",
+                        help="Bake static mesh children into their parent nodes")
+    parser.add_argument("--splice", action="store_true",
+                        help="Copy unchanged meshes from the sod files that are overwritten")
+    parser.add_argument("--package", default="",
+                        help="Mod folder to copy changed sod files and their textures to")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--results", help=argparse.SUPPRESS)
+    parser.add_argument("--catalog-id", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if not args.output and (args.export or not args.package):
+        parser.error("the following arguments are required: --output")
+    return args
+
+
+if __name__ == "__main__":
+    # Blender passes the worker arguments after "--"
+    if "--" in sys.argv:
+        args = parse_args(sys.argv[sys.argv.index("--") + 1:])
+    else:
+        args = parse_args(sys.argv[1:])
+    if args.worker:
+        run_worker(args)
+    elif args.export:
+        args.output = os.path.abspath(args.output)
+        sys.exit(run_export(args))
+    elif not args.output:
+        sys.exit(run_package(args, get_sod_files(args.files)))
+    else:
+        args.output = os.path.abspath(args.output)
+        args.batch_size = max(1, args.batch_size)
+        sys.exit(run_driver(args))
@@ -0,0 +1,279 @@
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# Import and export benchmark on generated sod files of several sizes. Runs
+# inside a background blender:
+#
+#   blender -b --factory-startup --python Benchmark.py --
+#       [--sizes small medium large] [--repeat 3] [--output results.json]
+#       [--baseline baseline.json] [--save-baseline baseline.json]
+#
+# Every phase is timed, the fastest of the repeats counts. The number of
+# blender datablocks and how far the memory use rose during the export are
+# recorded per size. With a baseline, phases that got slower than the tolerance and
+# changed datablock counts are listed and the exit code is 1.
+
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import Batch_Convert
+
+# Generated sod files, every size has its number of nodes, triangles over
+# all meshes, animated nodes and materials
+SIZES = {
+    "small": dict(nodes=20, triangles=2000, channels=2, materials=2),
+    "medium": dict(nodes=100, triangles=40000, channels=10, materials=8),
+    "large": dict(nodes=400, triangles=250000, channels=40, materials=16),
+}
+KEYFRAMES = 30
+TEXTURE_SIZE = 64
+DATABLOCKS = ("objects", "meshes", "materials", "images", "actions", "node_groups")
+PHASES = ("parse", "import", "materials", "mesh_build", "export")
+
+
+def make_mesh(SOD, rng, triangles, material_names, texture):
+    # Slightly bumpy grid, the quads take turns with the materials
+    columns = max(1, int(math.sqrt(triangles / 2)))
+    rows = max(1, triangles // (2 * columns))
+    verts = [(float(x), float(y), rng.uniform(-0.1, 0.1))
+             for y in range(rows + 1) for x in range(columns + 1)]
+    tcs = [(x / columns, y / rows) for y in range(rows + 1) for x in range(columns + 1)]
+    groups = [SOD.Vertex_group(name, []) for name in material_names]
+    for y in range(rows):
+        for x in range(columns):
+            a = y * (columns + 1) + x
+            b, c, d = a + 1, a + columns + 1, a + columns + 2
+            faces = groups[(y * columns + x) % len(groups)].faces
+            faces.append(SOD.Face([a, b, d], [a, b, d]))
+            faces.append(SOD.Face([a, d, c], [a, d, c]))
+    return SOD.Mesh(material="default", texture=texture, verts=verts, tcs=tcs,
+                    groups=[group for group in groups if group.faces])
+
+
+def make_sod(SOD, size, seed=0):
+    rng = random.Random(seed)
+    sod = SOD.SOD(1.8)
+    material_names = ["material{}".format(i) for i in range(size["materials"])]
+    for name in material_names:
+        sod.materials[name] = SOD.Material(name, diffuse=(rng.random(), rng.random(), rng.random()))
+
+    # A third of the nodes are hardpoints, the rest carries the meshes
+    sod.nodes["root"] = SOD.Node(0, "root", "")
+    sod.nodes["hardpoints"] = SOD.Node(0, "hardpoints", "root")
+    num_meshes = max(1, (size["nodes"] - 2) * 2 // 3)
+    num_hardpoints = max(0, size["nodes"] - 2 - num_meshes)
+    for i in range(num_hardpoints):
+        name = "hp_weapon_{}".format(i)
+        sod.nodes[name] = SOD.Node(0, name, "hardpoints", (1, 0, 0, 0, 1, 0, 0, 0, 1, rng.uniform(-5, 5), 0, 0))
+
+    triangles = max(2, size["triangles"] // num_meshes)
+    mesh_names = []
+    for i in range(num_meshes):
+        name = "mesh{}".format(i)
+        parent = "root" if i % 4 == 0 else mesh_names[i - i % 4]
+        texture = "texture{}".format(i % size["materials"])
+        sod.nodes[name] = SOD.Node(1, name, parent, (1, 0, 0, 0, 1, 0, 0, 0, 1, 0, 0, float(i % 4)),
+                                   mesh=make_mesh(SOD, rng, triangles, material_names, texture))
+        mesh_names.append(name)
+
+    for name in mesh_names[:size["channels"]]:
+        matrices = []
+        for frame in range(KEYFRAMES):
+            angle = 2.0 * math.pi * frame / KEYFRAMES
+            cos, sin = math.cos(angle), math.sin(angle)
+            matrices.append((cos, -sin, 0, sin, cos, 0, 0, 0, 1, 0, 0, 0))
+        sod.channels[name] = [SOD.Animation_channel(name, KEYFRAMES / 30.0, matrices)]
+    return sod
+
+
+def write_textures(texture_path, size):
+    # Uncompressed 24 bit targa files
+    os.makedirs(os.path.join(texture_path, "rgb"), exist_ok=True)
+    for i in range(size["materials"]):
+        with open(os.path.join(texture_path, "rgb", "texture{}.tga".format(i)), "wb") as f:
+            f.write(struct.pack("<BBBHHBHHHHBB", 0, 0, 2, 0, 0, 0, 0, 0,
+                                TEXTURE_SIZE, TEXTURE_SIZE, 24, 0))
+            f.write(bytes((i * 16 % 256, 128, 255 - i * 16 % 256)) * (TEXTURE_SIZE * TEXTURE_SIZE))
+
+
+def get_datablocks(bpy):
+    return {name: len(getattr(bpy.data, name)) for name in DATABLOCKS}
+
+
+def run_case(name, size, work_path):
+    import bpy
+    SOD = sys.modules[Batch_Convert.ADDON_NAME + ".SOD"]
+    Blender_SOD = sys.modules[Batch_Convert.ADDON_NAME + ".Blender_SOD"]
+    Blender_Materials = sys.modules[Batch_Convert.ADDON_NAME + ".Blender_Materials"]
+
+    sod_path = os.path.join(work_path, "sod", name + ".sod")
+    texture_path = os.path.join(work_path, "textures") + "/"
+    export_path = os.path.join(work_path, "export", name + ".sod")
+    if not os.path.isfile(sod_path):
+        os.makedirs(os.path.dirname(sod_path), exist_ok=True)
+        os.makedirs(os.path.dirname(export_path), exist_ok=True)
+        write_textures(texture_path, size)
+        make_sod(SOD, size).to_file(sod_path)
+
+    Batch_Convert.clear_data()
+    timings = {}
+    start = time.perf_counter()
+    sod = SOD.SOD.from_file_path(sod_path)
+    timings["parse"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    mesh_objects = Blender_SOD.Import_SOD(sod)
+    timings["import"] = time.perf_counter() - start
+
+    stats = {}
+    start = time.perf_counter()
+    Blender_Materials.finsh_object_materials(mesh_objects, texture_path, sod.materials, stats)
+    timings["materials"] = time.perf_counter() - start
+    timings["materials.textures"] = stats.get("timings", {}).get("textures", 0.0)
+    datablocks = get_datablocks(bpy)
+
+    start = time.perf_counter()
+    for obj in mesh_objects:
+        Blender_SOD.Make_meshes_from_objects([obj], 1.8)
+    timings["mesh_build"] = time.perf_counter() - start
+
+    options = Blender_SOD.Export_options(use_cache=False)
+    start = time.perf_counter()
+    Blender_SOD.Export_SOD(export_path, 1.8, options)
+    timings["export"] = time.perf_counter() - start
+    for phase, seconds in options.stats.get("timings", {}).items():
+        timings["export." + phase] = seconds
+
+    return {
+        "size": size,
+        "timings": timings,
+        "datablocks": datablocks,
+        "peak_memory": options.stats.get("peak_memory"),
+        "triangles": sum(len(group.faces) for node in sod.nodes.values() if node.mesh
+                         for group in node.mesh.groups),
+        "file_size": os.path.getsize(sod_path),
+    }
+
+
+def run_benchmark(sizes, repeat):
+    work_path = tempfile.mkdtemp(prefix="sta_benchmark_")
+    results = {}
+    try:
+        for name in sizes:
+            result = None
+            for i in range(repeat):
+                run = run_case(name, SIZES[name], work_path)
+                if result is None:
+                    result = run
+                    continue
+                for phase, seconds in run["timings"].items():
+                    result["timings"][phase] = min(result["timings"].get(phase, seconds), seconds)
+                if run["peak_memory"] is not None:
+                    result["peak_memory"] = max(result["peak_memory"] or 0, run["peak_memory"])
+            results[name] = result
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+    return results
+
+
+def print_results(results):
+    print("{:<8} {:>9} {:>14}".format("Size", "Triangles", "Export peak MB"), end="")
+    for phase in PHASES:
+        print(" {:>10}".format(phase), end="")
+    print()
+    for name, result in results.items():
+        peak_memory = (result["peak_memory"] or 0) / (1024 * 1024)
+        print("{:<8} {:>9} {:>14.1f}".format(name, result["triangles"], peak_memory), end="")
+        for phase in PHASES:
+            print(" {:>9.3f}s".format(result["timings"][phase]), end="")
+        print()
+    for name, result in results.items():
+        print(name, ", ".join("{} {}".format(key, count) for key, count in result["datablocks"].items()))
+
+
+def compare_results(results, baseline, tolerance, minimum):
+    # Returns a line for every slower phase and every changed datablock
+    # count. Differences below the minimum in seconds are noise
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        for phase, seconds in result["timings"].items():
+            old_seconds = old["timings"].get(phase)
+            if old_seconds is None:
+                continue
+            if seconds > old_seconds * (1.0 + tolerance) and seconds - old_seconds > minimum:
+                regressions.append("{} {}: {:.3f}s -> {:.3f}s (+{:.0f}%)".format(
+                    name, phase, old_seconds, seconds, 100.0 * (seconds / old_seconds - 1.0)))
+        for key, count in result["datablocks"].items():
+            if old["datablocks"].get(key, count) != count:
+                regressions.append("{} {}: {} -> {}".format(name, key, old["datablocks"][key], count))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the sod import and export inside blender")
+    parser.add_argument("--sizes", nargs="+", choices=tuple(SIZES), default=list(SIZES),
+                        help="Sizes of the generated sod files")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per size, the fastest counts")
+    parser.add_argument("--output", default="", help="Write the results to this json file")
+    parser.add_argument("--baseline", default="", help="Compare against the results in this json file")
+    parser.add_argument("--save-baseline", default="", help="Store the results as new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed slowdown against the baseline, 0.2 is 20%%")
+    parser.add_argument("--minimum", type=float, default=0.01,
+                        help="Ignore slowdowns of less than this many seconds")
+    return parser.parse_args(argv)
+
+
+def main():
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    args = parse_args(argv)
+    Batch_Convert.load_addon()
+
+    results = run_benchmark(args.sizes, max(1, args.repeat))
+    print_results(results)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    regressions = compare_results(results, baseline, args.tolerance, args.minimum)
+    for line in regressions:
+        print("Regression:", line)
+    if not regressions:
+        print("No regressions against", args.baseline)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
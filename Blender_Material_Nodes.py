@@ -235,4 +235,52 @@ class Material_Node(Generic_Node_Group):
         set_default_input(material_group, "Specular Color", [0.45, 0.45, 0.45, 1.0])
         set_default_input(material_group, "Specular Power", 50.0)
         
-        return material_group
\ No newline at end of file
+        return material_group
+
+class Point_Instance_Node(Generic_Node_Group):
+    name = "ST:A Point Instances"
+
+    @classmethod
+    def create_node_tree(self, variable) -> Point_Instance_Node:
+        instance_group = bpy.data.node_groups.new(self.name, 'GeometryNodeTree')
+        if bpy.app.version >= (4, 0, 0):
+            instance_group.is_modifier = True
+
+        group_inputs = instance_group.nodes.new('NodeGroupInput')
+        group_inputs.location = (-600, 0)
+        create_node_input(instance_group, 'NodeSocketGeometry', 'Geometry')
+
+        group_outputs = instance_group.nodes.new('NodeGroupOutput')
+        group_outputs.location = (600, 0)
+        create_node_output(instance_group, 'NodeSocketGeometry', 'Geometry')
+
+        cone = instance_group.nodes.new("GeometryNodeMeshCone")
+        cone.location = (-300, -200)
+        cone.inputs["Vertices"].default_value = 4
+        cone.inputs["Radius Bottom"].default_value = 0.1
+        cone.inputs["Depth"].default_value = 0.4
+
+        rotation = instance_group.nodes.new("GeometryNodeInputNamedAttribute")
+        rotation.location = (-300, -400)
+        rotation.data_type = 'FLOAT_VECTOR'
+        rotation.inputs["Name"].default_value = "sta_rotation"
+
+        instance = instance_group.nodes.new("GeometryNodeInstanceOnPoints")
+        instance.location = (0, 0)
+        instance_group.links.new(
+            group_inputs.outputs["Geometry"], instance.inputs["Points"])
+        instance_group.links.new(
+            cone.outputs["Mesh"], instance.inputs["Instance"])
+        instance_group.links.new(
+            rotation.outputs["Attribute"], instance.inputs["Rotation"])
+
+        # Keep the points themselves so they stay selectable in edit mode
+        join = instance_group.nodes.new("GeometryNodeJoinGeometry")
+        join.location = (300, 0)
+        instance_group.links.new(
+            group_inputs.outputs["Geometry"], join.inputs["Geometry"])
+        instance_group.links.new(
+            instance.outputs["Instances"], join.inputs["Geometry"])
+        instance_group.links.new(
+            join.outputs["Geometry"], group_outputs.inputs["Geometry"])
+        return instance_group
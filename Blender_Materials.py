@@ -1,7 +1,12 @@
 import bpy
+import logging
+import time
 from . import Blender_Material_Nodes
+from .Blender_SOD import Add_timing
 from mathutils import Vector
 
+log = logging.getLogger(__name__)
+
 FORMATS = (".tga", ".dds")
 IMG_PATHS = ("rgb/", "index8/", "dds/", "", "compressed/")
 
@@ -70,7 +75,7 @@ def set_material_custom_properties(mat_node, sod_mat):
     if "ST:A_Export" in material_group.nodes:
         material_group.nodes["ST:A_Export"].outputs[0].default_value = 1.0
 
-def finish_mat(mat, texture_path, sod_materials, img_node = None, mat_node = None):
+def finish_mat(mat, texture_path, sod_materials, img_node = None, mat_node = None, stats = None):
     mat.use_nodes = True
     out_node = None
     for node in mat.node_tree.nodes.values():
@@ -100,14 +105,16 @@ def finish_mat(mat, texture_path, sod_materials, img_node = None, mat_node = Non
 
         type = type.strip()
 
+        start = time.perf_counter()
         image = load_image(image_name, texture_path)
+        if stats is not None:
+            Add_timing(stats, "textures", start)
         img_node.image = image
         img_node.location = out_node.location + Vector([ -1200, 0])
         img_node.image.alpha_mode = 'CHANNEL_PACKED'
         mat.use_backface_culling = True if cull == "1" else False
     except Exception as e:
-        print(e)
-        print("Could not find image file for material:", mat.name)
+        log.warning("Could not find image file for material: %s (%s)", mat.name, e)
 
     thresholded = False
     if material != "":
@@ -177,10 +184,13 @@ def finish_mat(mat, texture_path, sod_materials, img_node = None, mat_node = Non
     else:
         mat.node_tree.links.new(out_node.inputs["Emission"], img_node.outputs["Color"])
 
-def finsh_object_materials(objects, texture_path, sod_materials):
+def finsh_object_materials(objects, texture_path, sod_materials, stats = None):
+    start = time.perf_counter()
     materials = set()
     for obj in objects:
         for mat in obj.data.materials:
             materials.add(mat)
     for mat in materials:
-        finish_mat(mat, texture_path, sod_materials)
\ No newline at end of file
+        finish_mat(mat, texture_path, sod_materials, stats=stats)
+    if stats is not None:
+        Add_timing(stats, "materials", start)
\ No newline at end of file
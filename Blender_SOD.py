@@ -1,7 +1,23 @@
 import bpy
+import hashlib
+import json
+import logging
+import os
+import re
+import struct
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from itertools import chain
 from mathutils import Matrix, Vector
+import numpy as np
 from numpy import array, dot, sqrt, average
 from .SOD import *
+from . import Blender_Material_Nodes
+from . import SOD_Mesh_Tools
+
+log = logging.getLogger(__name__)
 
 rotation_mat = Matrix((
                 [1.0, 0.0,  0.0,  0.0],
@@ -44,7 +60,460 @@ def mat34_from_blender(matrix, scale = Vector((1.0, 1.0, 1.0))):
     mat34[9:12] = export_matrix.col[3][0:3]
     return mat34
 
-def Import_SOD(sod):
+def Get_mesh_materials(sod_mesh):
+    materials = []
+    for group in sod_mesh.groups:
+        mat = "{}.{}.{}.{}".format(group.material, sod_mesh.texture, sod_mesh.cull_type, sod_mesh.material)
+        if mat not in materials:
+            materials.append(mat)
+    return materials
+
+def Hash_mesh_payload(sod_mesh, materials):
+    # Hashes everything that ends up in the blender mesh datablock, so equal
+    # hashes can safely share one datablock
+    payload = hashlib.sha1()
+    payload.update(struct.pack("<H", len(sod_mesh.verts)))
+    payload.update(struct.pack("<{}f".format(len(sod_mesh.verts) * 3), *chain.from_iterable(sod_mesh.verts)))
+    payload.update(struct.pack("<H", len(sod_mesh.tcs)))
+    payload.update(struct.pack("<{}f".format(len(sod_mesh.tcs) * 2), *chain.from_iterable(sod_mesh.tcs)))
+    for group in sod_mesh.groups:
+        payload.update(Identifier(group.material).to_bytearray())
+        payload.update(struct.pack("<H", len(group.faces)))
+        for face in group.faces:
+            payload.update(struct.pack("<6H", *face.indices, *face.tc_indices))
+    for mat in materials:
+        payload.update(Identifier(mat).to_bytearray())
+    return payload.hexdigest()
+
+def Get_mergeable_nodes(sod):
+    # Only static mesh nodes can live in the merged object. Animated nodes,
+    # everything below them and parents of animated nodes need real objects
+    animated = set(sod.channels) | set(sod.references)
+    parents_of_animated = set(sod.nodes[name].root for name in animated if name in sod.nodes)
+    static = {}
+    for node in sod.nodes.values():
+        static[node.name] = node.name not in animated and static.get(node.root, True)
+    return set(
+        node.name for node in sod.nodes.values()
+        if node.type == 1 and node.root and static[node.name] and node.name not in parents_of_animated)
+
+# Leaf nodes below these nodes can be imported as points
+POINT_NODE_PARENTS = ("hardpoints", "lights", "damage")
+POINT_NODE_TYPES = (0, 3, 12)
+
+def Get_point_nodes(sod, merged_nodes):
+    # Leaf null, sprite and emitter nodes anywhere below one of the point
+    # node parents. Animated nodes and children of merged nodes keep their
+    # own objects
+    animated = set(sod.channels) | set(sod.references)
+    parents = set(node.root for node in sod.nodes.values())
+    below = {}
+    for node in sod.nodes.values():
+        below[node.name] = node.name.lower() in POINT_NODE_PARENTS or below.get(node.root, False)
+    return set(
+        node.name for node in sod.nodes.values()
+        if node.type in POINT_NODE_TYPES and node.root and below.get(node.root, False)
+        and node.name not in parents and node.name not in animated and node.root not in merged_nodes)
+
+def Make_point_object(parent_name, point_nodes, root_node_name):
+    # One vertex per node in the space of its parent node. The raw mat34
+    # axes are stored, so the export writes the orientation back unchanged
+    name = "{}_points".format(parent_name)
+    mesh = bpy.data.meshes.new(name)
+    positions = []
+    rotations = []
+    axes = ([], [], [])
+    for node in point_nodes:
+        matrix = mat34_to_blender(node.mat34)
+        positions.append(matrix.translation)
+        rotations += matrix.to_euler()
+        for i, axis in enumerate(axes):
+            axis += node.mat34[i * 3:i * 3 + 3]
+    mesh.from_pydata(positions, [], [])
+
+    attributes = mesh.attributes
+    attributes.new("sta_node_type", 'INT', 'POINT').data.foreach_set(
+        "value", [node.type for node in point_nodes])
+    attributes.new("sta_rotation", 'FLOAT_VECTOR', 'POINT').data.foreach_set("vector", rotations)
+    for axis_name, axis in zip(("sta_axis_x", "sta_axis_y", "sta_axis_z"), axes):
+        attributes.new(axis_name, 'FLOAT_VECTOR', 'POINT').data.foreach_set("vector", axis)
+    names = attributes.new("sta_name", 'STRING', 'POINT').data
+    emitters = attributes.new("sta_emitter", 'STRING', 'POINT').data
+    for i, node in enumerate(point_nodes):
+        names[i].value = node.name
+        emitters[i].value = node.emitter if node.emitter else ""
+
+    point_object = bpy.data.objects.new(name, mesh)
+    bpy.context.collection.objects.link(point_object)
+    parent = bpy.data.objects.get(parent_name)
+    if parent is not None:
+        point_object.parent = parent
+        point_object.matrix_parent_inverse = Matrix.Identity(4)
+        if parent_name == root_node_name:
+            point_object.matrix_basis = rotation_mat.copy()
+
+    modifier = point_object.modifiers.new("ST:A Points", "NODES")
+    modifier.node_group = Blender_Material_Nodes.Point_Instance_Node.get_node_tree(None)
+    point_object["sta_point_nodes"] = len(point_nodes)
+    return point_object
+
+def Make_merged_object(root_node_name, node_worlds):
+    mesh = bpy.data.meshes.new("{}_merged".format(root_node_name))
+    merged_object = bpy.data.objects.new("{}_merged".format(root_node_name), mesh)
+    bpy.context.collection.objects.link(merged_object)
+    # The merged mesh is built in world space, keep the object at the origin
+    root_object = bpy.data.objects.get(root_node_name)
+    if root_object is not None:
+        merged_object.parent = root_object
+        merged_object.matrix_parent_inverse = node_worlds[root_node_name].inverted()
+    return merged_object
+
+def Fill_merged_mesh(merged_object, merged_nodes, node_worlds):
+    mesh = merged_object.data
+    vertices = []
+    local_positions = []
+    indices = []
+    tcs = []
+    source_tcs = []
+    material_ids = []
+    node_ids = []
+    materials = []
+    records = []
+
+    for node_index, node in enumerate(merged_nodes):
+        world = node_worlds[node.name]
+        offset = len(vertices)
+        for v in node.mesh.verts:
+            local = Vector(v) * Vector((-1, 1, 1))
+            local_positions += local
+            vertices.append(world @ local)
+
+        for group in node.mesh.groups:
+            mat = "{}.{}.{}.{}".format(group.material, node.mesh.texture, node.mesh.cull_type, node.mesh.material)
+            if mat not in materials:
+                materials.append(mat)
+            mat_index = materials.index(mat)
+            for face in group.faces:
+                indices.append([index + offset for index in face.indices])
+                for index in face.tc_indices:
+                    face_tc = node.mesh.tcs[index]
+                    tcs.append(face_tc[0])
+                    tcs.append(1.0-face_tc[1])
+                    source_tcs += face_tc
+                material_ids.append(mat_index)
+                node_ids.append(node_index)
+
+        records.append({
+            "name": node.name,
+            "root": node.root,
+            "type": node.type,
+            "mat34": list(node.mat34),
+            "world": [value for row in world for value in row],
+            "material": node.mesh.material.strip() if node.mesh.material else "default",
+            "texture": node.mesh.texture if node.mesh.texture else "",
+            "cull_type": node.mesh.cull_type,
+            "illumination": node.mesh.illumination,
+            "bumpmap": node.mesh.bumpmap if node.mesh.bumpmap else "",
+            "use_heightmap": node.mesh.use_heightmap,
+            "assimilation_texture": node.mesh.assimilation_texture if node.mesh.assimilation_texture else "",
+        })
+
+    mesh.from_pydata(vertices, [], indices)
+
+    for mat_name in materials:
+        mat = bpy.data.materials.get(mat_name)
+        if (mat is None):
+            mat = bpy.data.materials.new(name=mat_name)
+        mesh.materials.append(mat)
+
+    mesh.polygons.foreach_set("material_index", material_ids)
+
+    mesh.uv_layers.new(do_init=False, name="UVMap")
+    mesh.uv_layers["UVMap"].data.foreach_set("uv", tcs)
+
+    # Untouched geometry is written back from these, so round trips stay exact
+    mesh.attributes.new("sta_node_index", 'INT', 'FACE').data.foreach_set("value", node_ids)
+    mesh.attributes.new("sta_local_position", 'FLOAT_VECTOR', 'POINT').data.foreach_set("vector", local_positions)
+    mesh.attributes.new("sta_source_tc", 'FLOAT2', 'CORNER').data.foreach_set("vector", source_tcs)
+
+    if bpy.app.version < (4, 1, 0):
+        mesh.use_auto_smooth = True
+
+    for poly in mesh.polygons:
+        poly.use_smooth = True
+
+    merged_object["sta_merged_nodes"] = json.dumps(records)
+
+def Reduce_keyframes(values, tolerance):
+    # Drops keys as long as linear interpolation between the remaining keys
+    # reproduces every sampled frame within the tolerance. Each pass only
+    # tests every other key, so the tested segments never overlap
+    count = len(values)
+    keep = np.ones(count, dtype=bool)
+    frames = np.arange(count)
+    parity = 0
+    failed_passes = 0
+    while failed_passes < 2:
+        kept = np.flatnonzero(keep)
+        candidates = np.arange(1 + parity, len(kept) - 1, 2)
+        parity ^= 1
+        if len(candidates) == 0:
+            failed_passes += 1
+            continue
+
+        previous_keys = kept[candidates - 1]
+        next_keys = kept[candidates + 1]
+        segment = np.minimum(np.searchsorted(next_keys, frames), len(candidates) - 1)
+        in_segment = (frames > previous_keys[segment]) & (frames < next_keys[segment])
+        segment = segment[in_segment]
+        segment_frames = frames[in_segment]
+
+        start = previous_keys[segment]
+        end = next_keys[segment]
+        factor = (segment_frames - start) / (end - start)
+        interpolated = values[start] + (values[end] - values[start]) * factor
+        error = np.zeros(len(candidates))
+        np.maximum.at(error, segment, np.abs(values[segment_frames] - interpolated))
+
+        removable = error <= tolerance
+        if not removable.any():
+            failed_passes += 1
+            continue
+        failed_passes = 0
+        keep[kept[candidates[removable]]] = False
+    return keep
+
+def Write_keyframes(node_object, data_paths, group, values, tolerance, stats):
+    # values holds one row per frame starting at frame 0 and one column per
+    # fcurve of the given data paths
+    for data_path, _ in data_paths:
+        node_object.keyframe_insert(data_path, frame=0, group=group)
+    action = node_object.animation_data.action
+
+    column = 0
+    for data_path, size in data_paths:
+        for index in range(size):
+            curve_values = values[:, column]
+            column += 1
+            if tolerance > 0.0:
+                keep = Reduce_keyframes(curve_values, tolerance)
+            else:
+                keep = np.ones(len(curve_values), dtype=bool)
+            keep[0] = True
+            frames = np.flatnonzero(keep)
+
+            # The curve already has its frame 0 key from above, foreach_set
+            # needs values for every point including that one
+            fcurve = action.fcurves.find(data_path, index=index)
+            fcurve.keyframe_points.add(len(frames) - 1)
+            coordinates = np.empty((len(frames), 2), dtype=np.float32)
+            coordinates[:, 0] = frames
+            coordinates[:, 1] = curve_values[frames]
+            fcurve.keyframe_points.foreach_set("co", coordinates.ravel())
+            if tolerance > 0.0:
+                # Only linear interpolation is guaranteed to stay within the tolerance
+                fcurve.keyframe_points.foreach_set("interpolation", [1] * len(fcurve.keyframe_points))
+            fcurve.update()
+
+            stats["animation_keys"] += len(curve_values)
+            stats["written_keys"] += len(frames)
+
+def Get_mesh(node, known_meshes, stats):
+    materials = Get_mesh_materials(node.mesh)
+    payload_hash = Hash_mesh_payload(node.mesh, materials)
+    if known_meshes is not None:
+        mesh = Find_known_mesh(known_meshes, payload_hash)
+        if mesh is not None and [mat.name if mat else "" for mat in mesh.materials] == materials:
+            stats["reused_meshes"] += 1
+            return mesh
+
+    mesh = bpy.data.meshes.new(node.name)
+    Fill_mesh(mesh, node, materials)
+    Set_payload_hash(mesh, payload_hash)
+    if known_meshes is not None:
+        known_meshes[payload_hash] = mesh
+    return mesh
+
+def Hash_mesh_geometry(mesh):
+    # Everything Fill_mesh writes, to notice meshes edited after the import
+    payload = hashlib.sha1()
+    for data, attribute, size, dtype in (
+            (mesh.vertices, "co", 3, np.float32),
+            (mesh.loops, "vertex_index", 1, np.int32),
+            (mesh.polygons, "material_index", 1, np.int32)):
+        values = np.empty(len(data) * size, dtype=dtype)
+        data.foreach_get(attribute, values)
+        payload.update(values.tobytes())
+    for uv_layer in mesh.uv_layers:
+        values = np.empty(len(uv_layer.data) * 2, dtype=np.float32)
+        uv_layer.data.foreach_get("uv", values)
+        payload.update(values.tobytes())
+    return payload.hexdigest()
+
+def Get_geometry_counts(mesh):
+    return [len(mesh.vertices), len(mesh.loops), len(mesh.polygons)]
+
+def Set_payload_hash(mesh, payload_hash):
+    mesh["sta_payload_hash"] = payload_hash
+    mesh["sta_geometry_counts"] = Get_geometry_counts(mesh)
+    mesh["sta_geometry_hash"] = Hash_mesh_geometry(mesh)
+
+def Get_known_meshes():
+    # Meshes that were edited since they were imported no longer match
+    # their payload and can't be shared. Only the counts are compared here,
+    # the geometry hash is checked once a payload is actually reused
+    known_meshes = {}
+    for mesh in bpy.data.meshes:
+        if "sta_payload_hash" not in mesh:
+            continue
+        counts = mesh.get("sta_geometry_counts")
+        if counts is not None and list(counts) != Get_geometry_counts(mesh):
+            continue
+        known_meshes.setdefault(mesh["sta_payload_hash"], []).append(mesh)
+    return known_meshes
+
+def Find_known_mesh(known_meshes, payload_hash):
+    # Entries are either a checked mesh or a list of unchecked candidates
+    mesh = known_meshes.get(payload_hash)
+    if not isinstance(mesh, list):
+        return mesh
+    for candidate in mesh:
+        if candidate.get("sta_geometry_hash") == Hash_mesh_geometry(candidate):
+            known_meshes[payload_hash] = candidate
+            return candidate
+    del known_meshes[payload_hash]
+    return None
+
+def Set_mesh_properties(node_object, node):
+    node_object.sta_dynamic_props.material_type = node.mesh.material.strip() if node.mesh.material else "default"
+    node_object.sta_dynamic_props.texture_name = node.mesh.texture if node.mesh.texture else ""
+    node_object.sta_dynamic_props.face_cull = str(node.mesh.cull_type)
+
+    node_object.sta_II_dynamic_props.self_illumination = node.mesh.illumination
+    node_object.sta_II_dynamic_props.bumpmap_texture_name = (
+        node.mesh.bumpmap if node.mesh.bumpmap else "")
+    node_object.sta_II_dynamic_props.bumpmap_type = "512" if node.mesh.use_heightmap else "0"
+    node_object.sta_II_dynamic_props.assimilation_texture_name = (
+        node.mesh.assimilation_texture if node.mesh.assimilation_texture else "")
+
+def Make_node_object(node, known_meshes, stats):
+    if node.type == 1:
+        node_object = bpy.data.objects.new(node.name, Get_mesh(node, known_meshes, stats))
+        bpy.context.collection.objects.link(node_object)
+        Set_mesh_properties(node_object, node)
+        node_object.sta_dynamic_props.texture_animated = False
+    elif node.type == 12:
+        bpy.ops.object.empty_add(type="ARROWS")
+        tag_obj = bpy.context.object
+        tag_obj.name = node.name
+        node_object = tag_obj
+        node_object["emitter"] = node.emitter
+    else:
+        bpy.ops.object.empty_add(type="ARROWS")
+        tag_obj = bpy.context.object
+        tag_obj.name = node.name
+        node_object = tag_obj
+
+    node_object["node_type"] = node.type
+    node_object.sta_dynamic_props.animated = False
+    return node_object
+
+def Get_node_basis(node, root_node_name, merged_objects, node_worlds):
+    matrix = mat34_to_blender(node.mat34)
+    if node.root in merged_objects:
+        # The merged object sits at the world origin
+        return node_worlds[node.name]
+    if node.root and node.root == root_node_name:
+        return rotation_mat @ matrix
+    return matrix
+
+def Set_node_parent(node_object, node, root_node_name, merged_objects, node_worlds):
+    # Animation import relies on matrix_world holding the nodes own matrix
+    node_object.matrix_world = mat34_to_blender(node.mat34)
+    # Animations change the matrices, reload compares against this
+    node_object["sta_mat34"] = list(node.mat34)
+    parent = None
+    if node.root in merged_objects:
+        parent = merged_objects[node.root]
+        node_object["sta_root"] = node.root
+    elif node.root and node.root in bpy.data.objects:
+        parent = bpy.data.objects[node.root]
+    if parent is None:
+        return
+    node_object.parent = parent
+    node_object.matrix_parent_inverse = Matrix.Identity(4)
+    node_object.matrix_basis = Get_node_basis(node, root_node_name, merged_objects, node_worlds)
+
+def Add_node_world(node, root_node_name, node_worlds):
+    matrix = mat34_to_blender(node.mat34)
+    if node.root in node_worlds:
+        if node.root == root_node_name:
+            node_worlds[node.name] = node_worlds[node.root] @ rotation_mat @ matrix
+        else:
+            node_worlds[node.name] = node_worlds[node.root] @ matrix
+    else:
+        node_worlds[node.name] = matrix
+
+def Hash_channels(channel_list):
+    payload = hashlib.sha1()
+    for channel in channel_list:
+        payload.update(channel.to_bytearray())
+    return payload.hexdigest()
+
+def Import_animation_channel(node_object, channel, root_node_name, keyframe_tolerance, stats):
+    parent_object = node_object.parent
+    if not parent_object:
+        parent_matrix = Matrix.Identity(4)
+    else:
+        parent_matrix = parent_object.matrix_world
+        if parent_object.name == root_node_name:
+            parent_matrix = rotation_mat @ parent_matrix
+
+    num_frames = max(len(channel.matrices), len(channel.scales))
+    node_object.sta_dynamic_props.animated = True
+    node_object["start_frame"] = 1
+    node_object["end_frame"] = max(num_frames, node_object.get("end_frame", 0))
+    node_object["length"] = channel.length
+
+    if len(channel.scales):
+        values = [[*node_object.scale]]
+        values += [[scale, scale, scale] for scale in channel.scales]
+        Write_keyframes(node_object, (('scale', 3),), 'Sca', array(values), keyframe_tolerance, stats)
+    else:
+        # Same result as setting matrix_world, without the per frame updates
+        basis_matrix = Matrix.Identity(4)
+        if parent_object:
+            basis_matrix = (parent_object.matrix_world @ node_object.matrix_parent_inverse).inverted() @ parent_matrix
+        euler = node_object.rotation_euler.copy()
+        values = [[*node_object.location, *euler]]
+        for mat34 in channel.matrices:
+            matrix = basis_matrix @ mat34_to_blender(mat34)
+            euler = matrix.to_euler('XYZ', euler)
+            values.append([*matrix.translation, *euler])
+        Write_keyframes(
+            node_object, (('location', 3), ('rotation_euler', 3)), 'LocRot',
+            array(values), keyframe_tolerance, stats)
+
+    bpy.context.scene.frame_end = max(bpy.context.scene.frame_end, num_frames)
+
+def Import_animation_channels(node_object, channel_list, root_node_name, keyframe_tolerance, stats):
+    for channel in channel_list:
+        if not len(channel.matrices) and not len(channel.scales):
+            continue
+        Import_animation_channel(node_object, channel, root_node_name, keyframe_tolerance, stats)
+    node_object["sta_channel_hash"] = Hash_channels(channel_list)
+
+def Set_texture_animation(node_object, ref):
+    node_object.sta_dynamic_props.texture_animated = True
+    node_object["ref_animation"] = ref.anim
+    node_object["ref_type"] = ref.type
+    node_object["ref_offset"] = ref.offset
+
+def Import_SOD_steps(sod, reuse_meshes=True, stats=None, merge_meshes=False, point_nodes=False,
+                     keyframe_tolerance=0.0):
+    # Yields the number of the current step and the total number of steps
+    # before every node, animation channel and reference is added, so the
+    # import can be spread over several calls. Returns the mesh objects
     nodes = sod.nodes
     channels = sod.channels
     references = sod.references
@@ -53,147 +522,351 @@ def Import_SOD(sod):
     mesh_objects = []
     root_node_name = "root"
 
-    # Parse mesh data
-    for node in nodes.values():
-        node_object = None
-        if node.type == 1:
-            vertices = [Vector(v) * Vector((-1, 1, 1)) for v in node.mesh.verts]
-            indices = []
-            tcs = []
-            material_ids = []
-            materials = []
-            
-            for group in node.mesh.groups:
-                mat = "{}.{}.{}.{}".format(group.material, node.mesh.texture, node.mesh.cull_type, node.mesh.material)
-                if mat not in materials:
-                    materials.append(mat)
-                mat_index = materials.index(mat)
-                for face in group.faces:
-                    indices.append(face.indices)
-                    face_tcs = [node.mesh.tcs[index] for index in face.tc_indices]
-                    for face_tc in face_tcs:
-                        tcs.append(face_tc[0])
-                        tcs.append(1.0-face_tc[1])
-                    material_ids.append(mat_index)
-            
-            mesh = bpy.data.meshes.new(node.name)
-            mesh.from_pydata(vertices, [], indices)
-            
-            for mat_name in materials:
-                mat = bpy.data.materials.get(mat_name)
-                if (mat is None):
-                    mat = bpy.data.materials.new(name=mat_name)
-                
-                mesh.materials.append(mat)
-            
-            mesh.polygons.foreach_set("material_index", material_ids)
-            
-            mesh.uv_layers.new(do_init=False, name="UVMap")
-            mesh.uv_layers["UVMap"].data.foreach_set("uv", tcs)
-            
-            if bpy.app.version < (4, 1, 0):
-                mesh.use_auto_smooth = True
-
-            for poly in mesh.polygons:
-                poly.use_smooth = True
-            
-            node_object = bpy.data.objects.new(node.name, mesh)
-            bpy.context.collection.objects.link(node_object)
+    if stats is None:
+        stats = {}
+    stats["reused_meshes"] = 0
 
-            mesh_objects.append(node_object)
-            
-            node_object.sta_dynamic_props.material_type = node.mesh.material.strip() if node.mesh.material else "default"
-            node_object.sta_dynamic_props.texture_name = node.mesh.texture if node.mesh.texture else ""
-            node_object.sta_dynamic_props.face_cull = str(node.mesh.cull_type)
-            node_object.sta_dynamic_props.texture_animated = False
+    merged_nodes = set()
+    if merge_meshes:
+        merged_nodes = Get_mergeable_nodes(sod)
+    merged_object = None
+    merged_objects = {}
+    merged_records = []
+    node_worlds = {}
 
-            node_object.sta_II_dynamic_props.self_illumination = node.mesh.illumination
-            node_object.sta_II_dynamic_props.bumpmap_texture_name = (
-                node.mesh.bumpmap if node.mesh.bumpmap else "")
-            node_object.sta_II_dynamic_props.bumpmap_type = "512" if node.mesh.use_heightmap else "0"
-            node_object.sta_II_dynamic_props.assimilation_texture_name = (
-                node.mesh.assimilation_texture if node.mesh.assimilation_texture else "")
-            
-        elif node.type == 12:
-            bpy.ops.object.empty_add(type="ARROWS")
-            tag_obj = bpy.context.object
-            tag_obj.name = node.name
-            node_object = tag_obj
-            node_object["emitter"] = node.emitter
-        else:
-            bpy.ops.object.empty_add(type="ARROWS")
-            tag_obj = bpy.context.object
-            tag_obj.name = node.name
-            node_object = tag_obj
-            
-        node_object["node_type"] = node.type
-        node_object.sta_dynamic_props.animated = False
-        
-        matrix = mat34_to_blender(node.mat34)
-        node_object.matrix_world = matrix
+    point_node_names = set()
+    if point_nodes:
+        point_node_names = Get_point_nodes(sod, merged_nodes)
+    point_groups = {}
+
+    # Meshes from earlier imports can be shared as well
+    known_meshes = None
+    if reuse_meshes:
+        known_meshes = Get_known_meshes()
 
+    total_steps = len(nodes) + len(channels) + len(references)
+    steps = 0
+    # Only the time spent in here counts, not the time between the steps
+    timer = Phase_timer(stats)
+
+    # Parse mesh data
+    for node in nodes.values():
+        steps += 1
+        timer.stop()
+        yield steps, total_steps
+        timer.start("build")
         if not node.root or node.root == "":
             root_node_name = node.name
+        Add_node_world(node, root_node_name, node_worlds)
 
-        if node.root and node.root in bpy.data.objects:
-            if node.root == root_node_name:
-                node_object.matrix_world = rotation_mat @ matrix
-            node_object.parent = bpy.data.objects[node.root]
+        if node.name in merged_nodes:
+            if merged_object is None:
+                merged_object = Make_merged_object(root_node_name, node_worlds)
+                mesh_objects.append(merged_object)
+            merged_objects[node.name] = merged_object
+            merged_records.append(node)
+            continue
 
+        if node.name in point_node_names:
+            point_groups.setdefault(node.root, []).append(node)
+            continue
+
+        node_object = Make_node_object(node, known_meshes, stats)
+        if node.type == 1:
+            mesh_objects.append(node_object)
+        Set_node_parent(node_object, node, root_node_name, merged_objects, node_worlds)
         objects.append(node_object)
 
+    if merged_object is not None:
+        Fill_merged_mesh(merged_object, merged_records, node_worlds)
+
+    for parent_name, group_nodes in point_groups.items():
+        Make_point_object(parent_name, group_nodes, root_node_name)
+    stats["point_nodes"] = len(point_node_names)
+
     # Parse animations
+    stats["animation_keys"] = 0
+    stats["written_keys"] = 0
     bpy.context.scene.frame_end = 1
     for channel_list in list(channels.values())[::-1]:
-        for channel in channel_list:
-            if not len(channel.matrices) and not len(channel.scales):
-                continue
-            
-            node_object = bpy.data.objects.get(channel.name)
-            if not node_object:
-                print("Could not find correct animation object node for channel", channel.name)
-                continue
-            
-            parent_object = node_object.parent
-            if not parent_object:
-                parent_matrix = Matrix.Identity(4)
-            else:
-                parent_matrix = parent_object.matrix_world
-                if parent_object.name == root_node_name:
-                    parent_matrix = rotation_mat @ parent_matrix
-            
-            node_object.sta_dynamic_props.animated = True
-            node_object["start_frame"] = 1
-            node_object["end_frame"] = len(channel.matrices)
-            node_object["length"] = channel.length
-            
-            if len(channel.scales):
-                node_object.keyframe_insert('scale', frame=0, group='Sca')
-            else:
-                node_object.keyframe_insert('location', frame=0, group='LocRot')
-                node_object.keyframe_insert('rotation_euler', frame=0, group='LocRot')
-            
-            for i in range(len(channel.matrices)):
-                node_object.matrix_world = parent_matrix @ mat34_to_blender(channel.matrices[i])
-                node_object.keyframe_insert('location', frame=i+1, group='LocRot')
-                node_object.keyframe_insert('rotation_euler', frame=i+1, group='LocRot')
-
-            for i in range(len(channel.scales)):
-                node_object.scale = Vector((channel.scales[i], channel.scales[i], channel.scales[i]))
-                node_object.keyframe_insert('scale', frame=i+1, group='Sca')
-
-            bpy.context.scene.frame_end = max(bpy.context.scene.frame_end, len(channel.matrices))
+        steps += 1
+        timer.stop()
+        yield steps, total_steps
+        timer.start("animation")
+        node_object = bpy.data.objects.get(channel_list[0].name)
+        if not node_object:
+            log.warning("Could not find correct animation object node for channel %s", channel_list[0].name)
+            continue
+        Import_animation_channels(node_object, channel_list, root_node_name, keyframe_tolerance, stats)
         
     # Parse texture animation info
     for ref in references.values():
-        node_object = bpy.data.objects.get(ref.node)
-        node_object.sta_dynamic_props.texture_animated = True
-        node_object["ref_animation"] = ref.anim
-        node_object["ref_type"] = ref.type
-        node_object["ref_offset"] = ref.offset
+        steps += 1
+        timer.stop()
+        yield steps, total_steps
+        timer.start("animation")
+        Set_texture_animation(bpy.data.objects.get(ref.node), ref)
 
+    timer.stop()
     return mesh_objects
 
+def Run_steps(steps):
+    # Runs a step generator to its end and returns its result
+    while True:
+        try:
+            next(steps)
+        except StopIteration as finished:
+            return finished.value
+
+def Import_SOD(sod, reuse_meshes=True, stats=None, merge_meshes=False, point_nodes=False,
+               keyframe_tolerance=0.0):
+    return Run_steps(Import_SOD_steps(
+        sod, reuse_meshes, stats, merge_meshes, point_nodes, keyframe_tolerance))
+
+# Everything an import can create, in the order it has to be removed
+IMPORT_DATA_COLLECTIONS = ("objects", "meshes", "materials", "actions", "images", "node_groups")
+
+def Get_data_snapshot():
+    return {name: set(data.as_pointer() for data in getattr(bpy.data, name))
+            for name in IMPORT_DATA_COLLECTIONS}
+
+def Remove_new_data(snapshot):
+    # Removes every datablock that was created after the snapshot
+    removed = 0
+    for name in IMPORT_DATA_COLLECTIONS:
+        collection = getattr(bpy.data, name)
+        for data in [data for data in collection if data.as_pointer() not in snapshot[name]]:
+            collection.remove(data)
+            removed += 1
+    return removed
+
+def Matrices_equal(matrix_a, matrix_b, epsilon=0.000001):
+    for row_a, row_b in zip(matrix_a, matrix_b):
+        for a, b in zip(row_a, row_b):
+            if abs(a - b) > epsilon:
+                return False
+    return True
+
+def Has_rest_matrix(node_object, node, basis):
+    if "sta_mat34" in node_object:
+        return all(abs(a - b) <= 0.000001 for a, b in zip(node_object["sta_mat34"], node.mat34))
+    # Objects from older imports only have their current matrix
+    return Matrices_equal(node_object.matrix_basis, basis)
+
+def Reload_SOD(sod, keyframe_tolerance=0.0, stats=None):
+    if stats is None:
+        stats = {}
+    for key in ("reused_meshes", "updated_meshes", "updated_nodes", "updated_animations",
+                "added_nodes", "removed_nodes", "skipped_nodes", "animation_keys", "written_keys"):
+        stats[key] = 0
+
+    root_node_name = "root"
+    for node in sod.nodes.values():
+        if not node.root:
+            root_node_name = node.name
+            break
+
+    # Gather the nodes of the previous import. Nodes stored in merged or
+    # point objects can't be updated one by one and are left as they are
+    scene_nodes = {}
+    merged_objects = {}
+    contained_nodes = set()
+    root_object = bpy.data.objects.get(root_node_name)
+    if root_object is not None:
+        for obj in [root_object, *root_object.children_recursive]:
+            if "sta_merged_nodes" in obj:
+                for record in Get_merged_records(obj):
+                    merged_objects[record["name"]] = obj
+                    contained_nodes.add(record["name"])
+                continue
+            if "sta_point_nodes" in obj:
+                if "sta_name" in obj.data.attributes:
+                    contained_nodes.update(value.value for value in obj.data.attributes["sta_name"].data)
+                continue
+            if "node_type" in obj:
+                scene_nodes[obj.name] = obj
+
+    known_meshes = Get_known_meshes()
+    mesh_objects = []
+    node_worlds = {}
+    moved_nodes = set()
+    for node in sod.nodes.values():
+        Add_node_world(node, root_node_name, node_worlds)
+        if node.name in contained_nodes:
+            stats["skipped_nodes"] += 1
+            continue
+
+        node_object = scene_nodes.pop(node.name, None)
+        if node_object is not None and (
+                node_object.get("node_type") != node.type or
+                (node_object.type == "MESH") != (node.type == 1)):
+            bpy.data.objects.remove(node_object)
+            stats["removed_nodes"] += 1
+            node_object = None
+
+        if node_object is None:
+            node_object = Make_node_object(node, known_meshes, stats)
+            Set_node_parent(node_object, node, root_node_name, merged_objects, node_worlds)
+            if node.type == 1:
+                mesh_objects.append(node_object)
+            stats["added_nodes"] += 1
+            continue
+
+        if node.type == 1:
+            materials = Get_mesh_materials(node.mesh)
+            payload_hash = Hash_mesh_payload(node.mesh, materials)
+            if node_object.data.get("sta_payload_hash") != payload_hash:
+                if node_object.data.users > 1:
+                    # Don't change the other users of a shared mesh
+                    node_object.data = Get_mesh(node, known_meshes, stats)
+                else:
+                    Fill_mesh(node_object.data, node, materials)
+                    Set_payload_hash(node_object.data, payload_hash)
+                    known_meshes[payload_hash] = node_object.data
+                Set_mesh_properties(node_object, node)
+                mesh_objects.append(node_object)
+                stats["updated_meshes"] += 1
+        elif node.type == 12 and node_object.get("emitter") != node.emitter:
+            node_object["emitter"] = node.emitter
+            stats["updated_nodes"] += 1
+
+        parent = merged_objects.get(node.root, bpy.data.objects.get(node.root) if node.root else None)
+        basis = Get_node_basis(node, root_node_name, merged_objects, node_worlds)
+        if node_object.parent != parent or not Has_rest_matrix(node_object, node, basis):
+            Set_node_parent(node_object, node, root_node_name, merged_objects, node_worlds)
+            # The first keyframe holds the old matrix
+            if "sta_channel_hash" in node_object:
+                moved_nodes.add(node.name)
+            stats["updated_nodes"] += 1
+
+    for node_object in scene_nodes.values():
+        bpy.data.objects.remove(node_object)
+        stats["removed_nodes"] += 1
+
+    # Only rebuild animations that changed
+    for node_object in bpy.data.objects:
+        if node_object.name not in sod.nodes or "node_type" not in node_object:
+            continue
+        channel_list = sod.channels.get(node_object.name)
+        channel_hash = Hash_channels(channel_list) if channel_list else None
+        if node_object.get("sta_channel_hash") == channel_hash and node_object.name not in moved_nodes:
+            continue
+        node_object.animation_data_clear()
+        for key in ("start_frame", "end_frame", "length", "sta_channel_hash"):
+            if key in node_object:
+                del node_object[key]
+        node_object.sta_dynamic_props.animated = False
+        node_object.matrix_basis = Get_node_basis(
+            sod.nodes[node_object.name], root_node_name, merged_objects, node_worlds)
+        if channel_list:
+            Import_animation_channels(node_object, channel_list, root_node_name, keyframe_tolerance, stats)
+        stats["updated_animations"] += 1
+
+    for node_object in bpy.data.objects:
+        if node_object.name not in sod.nodes or "node_type" not in node_object:
+            continue
+        ref = sod.references.get(node_object.name)
+        if ref is not None:
+            Set_texture_animation(node_object, ref)
+        elif node_object.sta_dynamic_props.texture_animated:
+            node_object.sta_dynamic_props.texture_animated = False
+
+    return mesh_objects
+
+LOD_MODIFIER_NAME = "ST:A LOD"
+
+def Is_mesh_node(obj):
+    if obj.type != "MESH" or "sta_point_nodes" in obj:
+        return False
+    return "node_type" not in obj or int(obj["node_type"]) == 1
+
+def Copy_lod_subtree(obj, parent, suffix, ratio):
+    # Linked copy, the mesh data stays shared and the decimate modifier
+    # reduces it on export
+    lod_copy = obj.copy()
+    lod_copy.name = obj.name + suffix
+    for collection in obj.users_collection:
+        collection.objects.link(lod_copy)
+    lod_copy.parent = parent
+    lod_copy.matrix_parent_inverse = obj.matrix_parent_inverse.copy()
+
+    modifier = lod_copy.modifiers.get(LOD_MODIFIER_NAME)
+    if modifier is None:
+        modifier = lod_copy.modifiers.new(LOD_MODIFIER_NAME, "DECIMATE")
+    modifier.decimate_type = "COLLAPSE"
+    modifier.ratio = ratio
+
+    for child in obj.children:
+        if Is_mesh_node(child):
+            Copy_lod_subtree(child, lod_copy, suffix, ratio)
+    return lod_copy
+
+def Make_lod_chain(obj, ratios):
+    # The lod control node replaces the object in the hierarchy, its
+    # children are the levels of detail, the most detailed one first
+    lod_node = bpy.data.objects.new("{}_lod".format(obj.name), None)
+    for collection in obj.users_collection:
+        collection.objects.link(lod_node)
+    lod_node["node_type"] = 11
+    lod_node.parent = obj.parent
+    # The lod node sits exactly on the parent, so nothing below it moves
+    obj.parent = lod_node
+    for i, ratio in enumerate(ratios):
+        Copy_lod_subtree(obj, lod_node, "_lod{}".format(i + 1), ratio)
+    return lod_node
+
+def Fill_mesh(mesh, node, materials):
+    # Writes the node geometry straight into the mesh, also used to update
+    # meshes in place on reload
+    num_faces = sum(len(group.faces) for group in node.mesh.groups)
+    positions = array(node.mesh.verts, dtype=np.float32).reshape(-1, 3)
+    positions[:, 0] *= -1.0
+    indices = []
+    tcs = []
+    material_ids = []
+
+    for group in node.mesh.groups:
+        mat = "{}.{}.{}.{}".format(group.material, node.mesh.texture, node.mesh.cull_type, node.mesh.material)
+        mat_index = materials.index(mat)
+        for face in group.faces:
+            indices += face.indices
+            for index in face.tc_indices:
+                face_tc = node.mesh.tcs[index]
+                tcs.append(face_tc[0])
+                tcs.append(1.0-face_tc[1])
+            material_ids.append(mat_index)
+
+    mesh.clear_geometry()
+    mesh.materials.clear()
+    mesh.vertices.add(len(positions))
+    mesh.vertices.foreach_set("co", positions.ravel())
+    mesh.loops.add(num_faces * 3)
+    mesh.loops.foreach_set("vertex_index", indices)
+    mesh.polygons.add(num_faces)
+    mesh.polygons.foreach_set("loop_start", range(0, num_faces * 3, 3))
+    if bpy.app.version < (4, 0, 0):
+        mesh.polygons.foreach_set("loop_total", [3] * num_faces)
+    mesh.update()
+
+    for mat_name in materials:
+        mat = bpy.data.materials.get(mat_name)
+        if (mat is None):
+            mat = bpy.data.materials.new(name=mat_name)
+
+        mesh.materials.append(mat)
+
+    mesh.polygons.foreach_set("material_index", material_ids)
+
+    if "UVMap" not in mesh.uv_layers:
+        mesh.uv_layers.new(do_init=False, name="UVMap")
+    mesh.uv_layers["UVMap"].data.foreach_set("uv", tcs)
+
+    if bpy.app.version < (4, 1, 0):
+        mesh.use_auto_smooth = True
+
+    mesh.polygons.foreach_set("use_smooth", [True] * num_faces)
+    mesh.update()
+
 def Get_material_name(mat):
     if mat is None:
         return "default"
@@ -221,180 +894,693 @@ def Get_texture_name(obj):
                 break
     return texture_name
 
-def Make_meshes_from_objects(objects, version):
-    meshes = []
-    depsgraph = bpy.context.evaluated_depsgraph_get()
-    current_positions = []
-    current_texture_coordinates = []
-    current_groups = {}
-    current_position_indices = {}
-    current_tc_indices = {}
+def Extract_mesh_data(obj, depsgraph, matrix=None):
+    # Pulls everything needed from the evaluated mesh into numpy arrays,
+    # one row per triangle corner. Positions are transformed by the matrix
+    # if one is given, otherwise only the world scale is applied
+    evaluated_obj = obj.evaluated_get(depsgraph)
+    try:
+        return Read_mesh_data(obj, evaluated_obj.to_mesh(), matrix)
+    finally:
+        # Free the evaluated mesh right away, everything needed was copied
+        evaluated_obj.to_mesh_clear()
+
+def Read_mesh_data(obj, mesh, matrix):
+    _, _, sca = obj.matrix_world.decompose()
+
+    if bpy.app.version < (4, 1, 0):
+        mesh.calc_normals_split()
+    mesh.calc_loop_triangles()
+
+    positions = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", positions)
+    positions = positions.reshape(-1, 3)
+    if matrix is None:
+        positions = positions * np.array(sca, dtype=np.float32)
+    else:
+        transform = np.array(matrix, dtype=np.float32)
+        positions = positions @ transform[:3, :3].T + transform[:3, 3]
+
+    normals = np.empty(len(mesh.loops) * 3, dtype=np.float32)
+    if bpy.app.version >= (4, 1, 0):
+        mesh.corner_normals.foreach_get("vector", normals)
+    else:
+        mesh.loops.foreach_get("normal", normals)
+    normals = normals.reshape(-1, 3)
+    if matrix is not None:
+        normals = normals @ np.linalg.inv(transform[:3, :3])
+        lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+        normals = np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0.0)
+
+    uvs = np.zeros(len(mesh.loops) * 2, dtype=np.float32)
+    if mesh.uv_layers.active is not None:
+        mesh.uv_layers.active.data.foreach_get("uv", uvs)
+    uvs = uvs.reshape(-1, 2)
+
+    num_triangles = len(mesh.loop_triangles)
+    triangle_loops = np.empty(num_triangles * 3, dtype=np.int32)
+    mesh.loop_triangles.foreach_get("loops", triangle_loops)
+    triangle_vertices = np.empty(num_triangles * 3, dtype=np.int32)
+    mesh.loop_triangles.foreach_get("vertices", triangle_vertices)
+    triangle_materials = np.zeros(num_triangles, dtype=np.int32)
+    mesh.loop_triangles.foreach_get("material_index", triangle_materials)
+    if matrix is not None and np.linalg.det(transform[:3, :3]) < 0.0:
+        # Mirrored, keep the faces pointing outwards
+        triangle_loops = triangle_loops.reshape(-1, 3)[:, (0, 2, 1)].ravel()
+        triangle_vertices = triangle_vertices.reshape(-1, 3)[:, (0, 2, 1)].ravel()
+
+    # Resolve every slot only once, several slots can share a name
+    material_names = ["default"]
+    if len(mesh.materials):
+        material_names = [Get_material_name(mat) for mat in mesh.materials]
+        triangle_materials = np.minimum(triangle_materials, len(material_names) - 1)
+
+    return {
+        "positions": positions[triangle_vertices],
+        "normals": normals[triangle_loops],
+        "uvs": uvs[triangle_loops],
+        "materials": np.asarray(material_names, dtype=object)[triangle_materials],
+    }
+
+def Unique_rows(rows):
+    # np.unique, but numbered in order of first occurrence like the old
+    # dictionary based deduplication. Adding 0.0 folds -0.0 into 0.0
+    _, first, inverse = np.unique(rows + 0.0, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return first[order], rank[inverse.reshape(-1)]
+
+def Concatenate_mesh_data(mesh_datas):
+    return {key: np.concatenate([data[key] for data in mesh_datas]) for key in mesh_datas[0]}
+
+def Optimize_face_order(position_indices, tc_indices, group_triangles, stats):
+    # The game draws (position, tc) pairs, so those are what gets cached
+    _, corner_ids = Unique_rows(np.stack((position_indices.ravel(), tc_indices.ravel()), axis=1))
+    corner_ids = corner_ids.reshape(-1, 3)
+    optimized = []
+    for triangles in group_triangles:
+        faces = corner_ids[triangles]
+        order = SOD_Mesh_Tools.optimize_vertex_cache(faces)
+        stats["acmr_triangles"] = stats.get("acmr_triangles", 0) + len(triangles)
+        stats["acmr_before"] = stats.get("acmr_before", 0.0) + (
+            SOD_Mesh_Tools.average_cache_miss_ratio(faces) * len(triangles))
+        stats["acmr_after"] = stats.get("acmr_after", 0.0) + (
+            SOD_Mesh_Tools.average_cache_miss_ratio(faces[order]) * len(triangles))
+        optimized.append(triangles[order])
+    return optimized
+
+def Index_mesh_data(mesh_data, options=None):
+    # Sod meshes have no normals, but vertices are still split along hard
+    # edges unless welding is enabled
+    if options is not None and options.weld_vertices:
+        position_first, position_indices = SOD_Mesh_Tools.weld_points(
+            mesh_data["positions"], options.weld_tolerance)
+        tc_first, tc_indices = SOD_Mesh_Tools.weld_points(mesh_data["uvs"], options.weld_tolerance)
+    else:
+        position_first, position_indices = Unique_rows(
+            np.concatenate((mesh_data["positions"], mesh_data["normals"]), axis=1))
+        tc_first, tc_indices = Unique_rows(mesh_data["uvs"])
+    return position_first, position_indices, tc_first, tc_indices
+
+def Build_mesh_data(mesh_data, options=None, node_name=""):
+    position_first, position_indices, tc_first, tc_indices = Index_mesh_data(mesh_data, options)
+    if options is not None and options.weld_vertices:
+        split_verts = len(Unique_rows(
+            np.concatenate((mesh_data["positions"], mesh_data["normals"]), axis=1))[0])
+        split_tcs = len(Unique_rows(mesh_data["uvs"])[0])
+        saved = options.stats.setdefault("welded", {}).setdefault(node_name, [0, 0])
+        saved[0] += split_verts - len(position_first)
+        saved[1] += split_tcs - len(tc_first)
+
+    position_indices = position_indices.reshape(-1, 3)
+    tc_indices = tc_indices.reshape(-1, 3)
+    materials = mesh_data["materials"]
+    if options is not None and options.weld_vertices:
+        position_indices, tc_indices, materials, used_positions, used_tcs, dropped = (
+            SOD_Mesh_Tools.drop_degenerate_faces(position_indices, tc_indices, materials))
+        position_first = position_first[used_positions]
+        tc_first = tc_first[used_tcs]
+        options.stats["degenerate_faces"] = options.stats.get("degenerate_faces", 0) + dropped
+
+    verts = mesh_data["positions"][position_first] * np.array((-1.0, 1.0, 1.0), dtype=np.float32)
+    tcs = mesh_data["uvs"][tc_first].astype(np.float64)
+    tcs[:, 1] = 1.0 - tcs[:, 1]
+
+    group_names, group_first = np.unique(materials, return_index=True)
+    group_names = group_names[np.argsort(group_first)]
+    group_triangles = [np.flatnonzero(materials == name) for name in group_names]
+
+    if options is not None and options.optimize_vertex_cache:
+        group_triangles = Optimize_face_order(position_indices, tc_indices, group_triangles, options.stats)
+        if options.renumber_vertices and len(group_triangles):
+            # Number vertices and tcs in the order they are drawn
+            triangle_order = np.concatenate(group_triangles)
+            old_order, remap = SOD_Mesh_Tools.first_use_order(position_indices[triangle_order], len(verts))
+            verts = verts[old_order]
+            position_indices = remap[position_indices]
+            old_order, remap = SOD_Mesh_Tools.first_use_order(tc_indices[triangle_order], len(tcs))
+            tcs = tcs[old_order]
+            tc_indices = remap[tc_indices]
+
+    groups = []
+    for name, triangles in zip(group_names, group_triangles):
+        groups.append(Vertex_group(str(name), [
+            Face(indices, face_tcs) for indices, face_tcs in zip(
+                position_indices[triangles].tolist(), tc_indices[triangles].tolist())]))
+
+    return [tuple(vert) for vert in verts.tolist()], [tuple(tc) for tc in tcs.tolist()], groups
+
+def Get_mesh_properties(obj):
+    # Everything a sod mesh needs from the object, so building the mesh
+    # doesn't need to touch blender data
+    return dict(
+        material = obj.sta_dynamic_props.material_type,
+        texture = Get_texture_name(obj),
+        cull_type = int(obj.sta_dynamic_props.face_cull),
+        illumination=obj.sta_II_dynamic_props.self_illumination,
+        bumpmap=obj.sta_II_dynamic_props.bumpmap_texture_name,
+        use_heightmap=obj.sta_II_dynamic_props.bumpmap_type == "512",
+        assimilation_texture=obj.sta_II_dynamic_props.assimilation_texture_name
+    )
 
+def Make_sod_mesh(mesh_properties, mesh_data, options=None, node_name=""):
+    verts, tcs, groups = Build_mesh_data(mesh_data, options, node_name)
+    return Mesh(
+        verts = verts,
+        tcs = tcs,
+        groups = groups,
+        **mesh_properties
+    )
+
+def Select_mesh_data(mesh_data, triangle_mask):
+    corner_mask = np.repeat(triangle_mask, 3)
+    return {
+        "positions": mesh_data["positions"][corner_mask],
+        "normals": mesh_data["normals"][corner_mask],
+        "uvs": mesh_data["uvs"][corner_mask],
+        "materials": mesh_data["materials"][triangle_mask],
+    }
+
+def Split_mesh_data(mesh_data, options=None):
+    # Splits the data into chunks that fit into the uint16 limits of a sod mesh
+    _, position_ids, _, tc_ids = Index_mesh_data(mesh_data, options)
+    _, group_ids = np.unique(mesh_data["materials"], return_inverse=True)
+    chunks, num_chunks = SOD_Mesh_Tools.partition_triangles(
+        mesh_data["positions"], position_ids, tc_ids, group_ids.reshape(-1))
+    if num_chunks == 1:
+        return [mesh_data]
+    return [Select_mesh_data(mesh_data, chunks == chunk) for chunk in range(num_chunks)]
+
+def Make_sod_meshes(mesh_job, versions, options=None):
+    # Only uses numpy and struct, so it can run on a worker thread
+    node_name, mesh_properties, mesh_data, _ = mesh_job
+    meshes = [Make_sod_mesh(mesh_properties, chunk, options, node_name)
+              for chunk in Split_mesh_data(mesh_data, options)]
+    for mesh in meshes:
+        for version in versions:
+            mesh.encoded[version] = bytes(mesh.to_bytearray(version))
+        if options is not None and not options.keep_mesh_data:
+            # Only the encoded data gets written
+            mesh.verts, mesh.tcs, mesh.groups = [], [], []
+    return meshes
+
+def Hash_mesh_job(objects, mesh_properties, mesh_data):
+    # Hashes everything the sod meshes are built from
+    payload = hashlib.sha1()
+    for key in ("positions", "normals", "uvs"):
+        payload.update(np.ascontiguousarray(mesh_data[key]).tobytes())
+    names, material_ids = np.unique(mesh_data["materials"], return_inverse=True)
+    payload.update(np.ascontiguousarray(material_ids, dtype=np.int32).tobytes())
+    descriptions = [sorted(mesh_properties.items()), [str(name) for name in names]]
     for obj in objects:
-        mesh = obj.evaluated_get(depsgraph).to_mesh()
+        descriptions.append([(modifier.name, modifier.type, modifier.show_viewport, modifier.show_render)
+                             for modifier in obj.modifiers])
+        descriptions.append([slot.name for slot in obj.material_slots])
+    payload.update(repr(descriptions).encode())
+    return payload.hexdigest()
 
-        loc, rot, sca = obj.matrix_world.decompose()
+def Make_mesh_job(objects, node_name):
+    # Additional objects are merged into the space of the first one
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    _, _, scale = objects[0].matrix_world.decompose()
+    to_node = Matrix.Diagonal((*scale, 1.0)) @ objects[0].matrix_world.inverted()
+    mesh_data = Concatenate_mesh_data(
+        [Extract_mesh_data(objects[0], depsgraph)] +
+        [Extract_mesh_data(obj, depsgraph, to_node @ obj.matrix_world) for obj in objects[1:]])
+    mesh_properties = Get_mesh_properties(objects[0])
+    return node_name, mesh_properties, mesh_data, Hash_mesh_job(objects, mesh_properties, mesh_data)
 
-        if bpy.app.version < (4, 1, 0):
-            mesh.calc_normals_split()
+def Make_meshes_from_objects(objects, version, options=None):
+    node_name = Get_node_name(objects[0].name, options.node_names if options is not None else None)
+    return Make_sod_meshes(Make_mesh_job(objects, node_name), (version,), options)
 
-        mesh.calc_loop_triangles()
-        positions = []
-        texture_coords = []
-        indices = {}
+def Merge_stats(stats, job_stats):
+    for key, value in job_stats.items():
+        if isinstance(value, dict):
+            stats.setdefault(key, {}).update(value)
+        else:
+            stats[key] = stats.get(key, 0) + value
 
-        for triangle in mesh.loop_triangles:
-            if len(mesh.materials) == 0:
-                mat_name = "default"
-            else:
-                mat = mesh.materials[triangle.material_index]
-                mat_name = Get_material_name(mat)
-
-            pos_indexes = []
-            tc_indexes = []
-            for vert, loop in zip(triangle.vertices, triangle.loops):
-                v = mesh.vertices[vert]
-                l = mesh.loops[loop]
-                pos = v.co.copy().freeze() * sca
-                normal = l.normal.copy().freeze()
-                tc = mesh.uv_layers.active.data[loop].uv.copy().freeze()
-                
-                pos_tuple = tuple([*pos, *normal])
-                tex_tuple = tuple([*tc])
-                if pos_tuple not in current_position_indices:
-                    index = len(positions) + len(current_positions)
-                    positions.append(pos * Vector((-1, 1, 1)))
-                    current_position_indices[pos_tuple] = index
-                pos_indexes.append(current_position_indices[pos_tuple])
-
-                if tex_tuple not in current_tc_indices:
-                    index = len(texture_coords) + len(current_texture_coordinates)
-                    texture_coords.append((tc[0], 1.0 - tc[1]))
-                    current_tc_indices[tex_tuple] = index
-                tc_indexes.append(current_tc_indices[tex_tuple])
-
-            if mat_name not in indices:
-                indices[mat_name] = []
-            indices[mat_name].append((pos_indexes, tc_indexes))
-
-        group_fits = True
-        for mat in indices:
-            if mat in current_groups:
-                if len(indices[mat]) + len(current_groups[mat]) > 65355:
-                    group_fits = False
-                    break
-                
-        # If everything still fits into one mesh, add everything and continue
-        if (len(current_positions) + len(positions) <= 65355 and 
-            len(current_texture_coordinates) + len(texture_coords) <= 65355 and
-            group_fits):
-
-            current_positions += positions
-            current_texture_coordinates += texture_coords
-
-            for mat in indices:
-                mat_faces = [Face(indices, tc_indices) for indices, tc_indices in indices[mat]]
-
-                if mat not in current_groups:
-                    current_groups[mat] = Vertex_group(mat, mat_faces)
-                else:
-                    current_groups[mat].faces += mat_faces
+# Built meshes of earlier exports in this session by job hash, limited by
+# the size of their encoded data
+EXPORT_CACHE_BYTES = 256 * 1024 * 1024
+Export_cache = {}
+Export_cache_bytes = 0
+# Background exports finish on a worker thread
+Export_cache_lock = threading.Lock()
+
+def Get_cache_key(mesh_job, options):
+    # Meshes don't depend on the sod version, missing encodings are added
+    # when the mesh is written
+    return (mesh_job[3], options.optimize_vertex_cache, options.renumber_vertices,
+            options.weld_vertices, options.weld_tolerance)
+
+# Exports with splicing keep the cache keys of the meshes in a file next to
+# the sod. The next export copies the encoded meshes of every key it finds
+# again straight from the old file
+SPLICE_EXTENSION = ".hashes"
+
+def Get_splice_key(key):
+    return json.dumps(key)
+
+def Load_splice_meshes(targets):
+    # Where the meshes of the files about to be overwritten are, by cache key.
+    # Only keys found in all targets count and only if the files are still
+    # what the last export wrote
+    splice_meshes = None
+    for file_path, version in targets:
+        try:
+            with open(file_path + SPLICE_EXTENSION, "r") as f:
+                record = json.load(f)
+            status = os.stat(file_path)
+            if (record["version"] != version or record["size"] != status.st_size or
+                    record["mtime"] != status.st_mtime_ns):
+                return {}
+            index = SOD_index.from_file_path(file_path)
+        except Exception:
+            return {}
+
+        found = {key: [(version, index, names)] for key, names in record["meshes"].items()
+                 if all(name in index.meshes for name in names)}
+        if splice_meshes is None:
+            splice_meshes = found
             continue
-        
-        # If new stuff doesnt fit anymore, create mesh for the old data
-        meshes.append(
-            Mesh(
-                material = obj.sta_dynamic_props.material_type,
-                texture = Get_texture_name(obj),
-                cull_type = obj.sta_dynamic_props.face_cull,
-                verts = current_positions,
-                tcs = current_texture_coordinates,
-                groups = current_groups.values()
-            ))
+        splice_meshes = {key: sources + found[key] for key, sources in splice_meshes.items()
+                         if key in found and len(found[key][0][2]) == len(sources[0][2])}
+    return splice_meshes or {}
 
-        # Redo current object...
-        current_position_indices = {}
-        current_tc_indices = {}
-        current_positions = []
-        current_texture_coordinates = []
-        current_groups = {}
+def Read_splice_meshes(sources):
+    # Meshes that only hold their encoded data for every version
+    meshes = [Mesh() for name in sources[0][2]]
+    for version, index, names in sources:
+        encoded = index.read_meshes(names)
+        for mesh, name in zip(meshes, names):
+            mesh.encoded[version] = encoded[name]
+    return meshes
 
-        positions = []
-        texture_coords = []
-        indices = {}
+def Write_splice_record(file_path, version, mesh_nodes):
+    status = os.stat(file_path)
+    with open(file_path + SPLICE_EXTENSION, "w") as f:
+        json.dump({
+            "version": version,
+            "size": status.st_size,
+            "mtime": status.st_mtime_ns,
+            "meshes": mesh_nodes,
+        }, f)
 
-        for triangle in mesh.loop_triangles:
-            if len(mesh.materials) == 0:
-                mat_name = "default"
-            else:
-                mat = mesh.materials[triangle.material_index]
-                mat_name = Get_material_name(mat)
-
-            pos_indexes = []
-            tc_indexes = []
-            for vert, loop in zip(triangle.vertices, triangle.loops):
-                v = mesh.vertices[vert]
-                l = mesh.loops[loop]
-                pos = v.co.copy().freeze() * sca
-                if mesh.has_custom_normals:
-                    normal = l.normal.copy().freeze()
-                else:
-                    normal = v.normal.copy().freeze()
-                tc = mesh.uv_layers.active.data[loop].uv.copy().freeze()
-                
-                pos_tuple = tuple([*pos, *normal])
-                tex_tuple = tuple([*tc])
-                if pos_tuple not in current_position_indices:
-                    index = len(positions) + len(current_position_indices)
-                    positions.append(pos * Vector((-1, 1, 1)))
-                    current_position_indices[pos_tuple] = index
-                pos_indexes.append(current_position_indices[pos_tuple])
-
-                if tex_tuple not in current_tc_indices:
-                    index = len(texture_coords) + len(current_tc_indices)
-                    texture_coords.append((tc[0], 1.0 - tc[1]))
-                    current_tc_indices[tex_tuple] = index
-                tc_indexes.append(current_tc_indices[tex_tuple])
-
-            if mat_name not in indices:
-                indices[mat_name] = []
-            indices[mat_name].append((pos_indexes, tc_indexes))
-        
-        current_positions += positions
-        current_texture_coordinates += texture_coords
-        for mat in indices:
-            mat_faces = [Face(indices, tc_indices) for indices, tc_indices in indices[mat]]
-            if mat not in current_groups:
-                current_groups[mat] = Vertex_group(mat, mat_faces)
-            else:
-                current_groups[mat].faces += mat_faces
-
-    if len(current_positions) > 0:
-        meshes.append(
-            Mesh(
-                material = obj.sta_dynamic_props.material_type,
-                texture = obj.sta_dynamic_props.texture_name,
-                cull_type = int(obj.sta_dynamic_props.face_cull),
-                verts = current_positions,
-                tcs = current_texture_coordinates,
-                groups = current_groups.values(),
-                illumination=obj.sta_II_dynamic_props.self_illumination,
-                bumpmap=obj.sta_II_dynamic_props.bumpmap_texture_name,
-                use_heightmap=obj.sta_II_dynamic_props.bumpmap_type == "512",
-                assimilation_texture=obj.sta_II_dynamic_props.assimilation_texture_name
+def Get_encoded_size(result):
+    meshes, _ = result
+    return sum(len(data) for mesh in meshes for data in mesh.encoded.values())
+
+class Mesh_builder:
+    # Builds the meshes of the jobs on a thread pool while the object tree
+    # is still being walked. A job and its extracted data are released as
+    # soon as its meshes are built. Extraction is faster than building, so
+    # only a few jobs per worker may wait in the queue
+    def __init__(self, versions, options, splice_meshes=None):
+        self.versions = versions
+        self.options = options
+        self.splice_meshes = splice_meshes or {}
+        self.node_names = []
+        self.keys = []
+        self.results = []
+        self.pending = []
+        # Stopped once the files are written
+        self.memory = Memory_sampler()
+        max_workers = options.max_workers or os.cpu_count() or 1
+        self.max_pending = 2 * max_workers
+        self.executor = None
+        if max_workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def run(self, mesh_job):
+        # Every job gets its own stats
+        Check_cancelled(self.options)
+        job_options = replace(self.options, stats={})
+        return Make_sod_meshes(mesh_job, self.versions, job_options), job_options.stats
+
+    def add_to_cache(self, key, result):
+        global Export_cache_bytes
+        if not self.options.use_cache:
+            return
+        with Export_cache_lock:
+            if key in Export_cache:
+                Export_cache_bytes -= Get_encoded_size(Export_cache.pop(key))
+            Export_cache[key] = result
+            Export_cache_bytes += Get_encoded_size(result)
+            while Export_cache_bytes > EXPORT_CACHE_BYTES:
+                Export_cache_bytes -= Get_encoded_size(Export_cache.pop(next(iter(Export_cache))))
+
+    def get_from_cache(self, key):
+        if not self.options.use_cache:
+            return None
+        with Export_cache_lock:
+            result = Export_cache.pop(key, None)
+            if result is None:
+                return None
+            # Move to the end, so the least recently used entries go first
+            Export_cache[key] = result
+        # Cached meshes can't be encoded for other versions anymore
+        if not all(version in mesh.encoded for mesh in result[0] for version in self.versions):
+            return None
+        return result
+
+    def add(self, mesh_job):
+        key = Get_cache_key(mesh_job, self.options)
+        self.node_names.append(mesh_job[0])
+        self.keys.append(key)
+        result = self.get_from_cache(key)
+        if result is not None:
+            self.options.stats["cached_meshes"] = self.options.stats.get("cached_meshes", 0) + 1
+            self.results.append(result)
+        elif Get_splice_key(key) in self.splice_meshes:
+            self.options.stats["spliced_meshes"] = self.options.stats.get("spliced_meshes", 0) + 1
+            self.results.append((Read_splice_meshes(self.splice_meshes[Get_splice_key(key)]), {}))
+        elif self.executor is None:
+            result = self.run(mesh_job)
+            self.add_to_cache(key, result)
+            self.results.append(result)
+        else:
+            self.pending = [future for future in self.pending if not future.done()]
+            if len(self.pending) >= self.max_pending:
+                # Waits without raising, errors come up in finish
+                self.pending.pop(0).exception()
+            future = self.executor.submit(self.run, mesh_job)
+            self.pending.append(future)
+            self.results.append(future)
+
+    def progress(self):
+        done = sum(1 for result in self.results if not isinstance(result, Future) or result.done())
+        return done, len(self.results)
+
+    def finish(self):
+        # Returns the node names and their meshes in the order of the jobs
+        built = []
+        for node_name, key, result in zip(self.node_names, self.keys, self.results):
+            Check_cancelled(self.options)
+            if isinstance(result, Future):
+                result = result.result()
+                self.add_to_cache(key, result)
+            meshes, job_stats = result
+            Merge_stats(self.options.stats, job_stats)
+            built.append((node_name, meshes))
+        self.results = []
+        return built
+
+    def close(self):
+        self.pending = []
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+# Blender adds .001 style suffixes to names that are taken already
+NAME_SUFFIX = re.compile(r"\.\d{3}$")
+
+def Get_node_name(name, node_names=None):
+    # node_names holds the objects that don't just get their dots replaced
+    if node_names and name in node_names:
+        return node_names[name]
+    return name.replace(".", "_")
+
+def Strip_name_suffix(name):
+    return NAME_SUFFIX.sub("", name)
+
+def Get_stripped_node_names(root):
+    # Several ships in one file can't all have a "root" or "hull". Drops the
+    # suffixes again, unless two nodes of the ship would end up with the
+    # same name
+    objects = [root, *root.children_recursive]
+    stripped = [Strip_name_suffix(obj.name).replace(".", "_") for obj in objects]
+    counts = {}
+    for name in stripped:
+        counts[name] = counts.get(name, 0) + 1
+    node_names = {}
+    for obj, name in zip(objects, stripped):
+        node_names[obj.name] = name if counts[name] == 1 else obj.name.replace(".", "_")
+    if len(set(node_names.values())) < len(node_names):
+        return {}
+    return node_names
+
+def Get_merged_records(obj):
+    records = json.loads(obj["sta_merged_nodes"])
+    for record in records:
+        record["world"] = Matrix([record["world"][i*4:i*4+4] for i in range(4)])
+    return records
+
+def Get_parent_matrix(obj, node_names=None):
+    # Children of merged nodes are parented to the merged object, but
+    # still belong to their original node
+    parent = obj.parent
+    if "sta_merged_nodes" in parent:
+        if "sta_root" in obj:
+            for record in Get_merged_records(parent):
+                if record["name"] == obj["sta_root"]:
+                    return Get_node_name(record["name"], node_names), parent.matrix_world @ record["world"]
+        if parent.parent:
+            return Get_parent_matrix(parent, node_names)
+    return Get_node_name(parent.name, node_names), parent.matrix_world
+
+def Read_merged_mesh_data(mesh, records):
+    # Splits the merged mesh back into the mesh data of every node
+    mesh.calc_loop_triangles()
+    num_triangles = len(mesh.loop_triangles)
+    triangle_loops = np.empty(num_triangles * 3, dtype=np.int32)
+    mesh.loop_triangles.foreach_get("loops", triangle_loops)
+    triangle_vertices = np.empty(num_triangles * 3, dtype=np.int32)
+    mesh.loop_triangles.foreach_get("vertices", triangle_vertices)
+    triangle_polygons = np.empty(num_triangles, dtype=np.int32)
+    mesh.loop_triangles.foreach_get("polygon_index", triangle_polygons)
+    triangle_materials = np.zeros(num_triangles, dtype=np.int32)
+    mesh.loop_triangles.foreach_get("material_index", triangle_materials)
+    node_ids = np.zeros(len(mesh.polygons), dtype=np.int32)
+    mesh.attributes["sta_node_index"].data.foreach_get("value", node_ids)
+
+    positions = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", positions)
+    positions = positions.reshape(-1, 3)
+    local_positions = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.attributes["sta_local_position"].data.foreach_get("vector", local_positions)
+    local_positions = local_positions.reshape(-1, 3)
+
+    uvs = np.zeros(len(mesh.loops) * 2, dtype=np.float32)
+    if mesh.uv_layers.active is not None:
+        mesh.uv_layers.active.data.foreach_get("uv", uvs)
+    uvs = uvs.reshape(-1, 2)
+    source_tcs = np.empty(len(mesh.loops) * 2, dtype=np.float32)
+    mesh.attributes["sta_source_tc"].data.foreach_get("vector", source_tcs)
+    # Use the imported tcs unless the uvs were edited
+    tcs = source_tcs.reshape(-1, 2).astype(np.float64)
+    tcs[:, 1] = 1.0 - tcs[:, 1]
+    edited = np.any(np.abs(tcs - uvs) > 0.000001, axis=1)
+    tcs[edited] = uvs[edited]
+
+    material_names = ["default"]
+    if len(mesh.materials):
+        material_names = [Get_material_name(mat) for mat in mesh.materials]
+        triangle_materials = np.minimum(triangle_materials, len(material_names) - 1)
+    triangle_materials = np.asarray(material_names, dtype=object)[triangle_materials]
+
+    node_indices, triangle_nodes = np.unique(node_ids[triangle_polygons], return_inverse=True)
+    order = np.argsort(triangle_nodes.reshape(-1), kind="stable")
+    splits = np.cumsum(np.bincount(triangle_nodes.reshape(-1), minlength=len(node_indices)))[:-1]
+    node_triangles = dict(zip(node_indices.tolist(), np.split(order, splits)))
+
+    mesh_datas = []
+    for record_index, record in enumerate(records):
+        triangles = node_triangles.get(record_index, np.empty(0, dtype=np.int64))
+        corners = (triangles[:, None] * 3 + np.arange(3)).ravel()
+        vertices = triangle_vertices[corners]
+
+        # Use the imported positions unless the vertices were edited
+        world = np.array(record["world"], dtype=np.float64)
+        local = local_positions[vertices].astype(np.float64)
+        co = positions[vertices].astype(np.float64)
+        moved = np.linalg.norm(local @ world[:3, :3].T + world[:3, 3] - co, axis=1) > 0.00001
+        local[moved] = (co[moved] - world[:3, 3]) @ np.linalg.inv(world[:3, :3]).T
+
+        mesh_datas.append({
+            "positions": local.astype(np.float32),
+            # Merged nodes keep their imported vertices, don't split them again
+            "normals": np.zeros((len(corners), 3), dtype=np.float32),
+            "uvs": tcs[triangle_loops[corners]],
+            "materials": triangle_materials[triangles],
+        })
+    return mesh_datas
+
+def Add_merged_sod_nodes(obj, nodes, node_names=None, options=None):
+    records = Get_merged_records(obj)
+    for record, mesh_data in zip(records, Read_merged_mesh_data(obj.data, records)):
+        node_name = Get_node_name(record["name"], node_names)
+        mesh_properties = dict(
+            material = record["material"],
+            texture = record["texture"],
+            cull_type = int(record["cull_type"]),
+            illumination = record["illumination"],
+            bumpmap = record["bumpmap"],
+            use_heightmap = record["use_heightmap"],
+            assimilation_texture = record["assimilation_texture"]
+        )
+        nodes[node_name] = Node(
+            type = record["type"],
+            name = node_name,
+            root = Get_node_name(record["root"], node_names),
+            mat34 = record["mat34"],
+            mesh = Make_sod_mesh(mesh_properties, mesh_data, options, node_name))
+
+def Add_point_sod_nodes(obj, nodes, root_name, node_names=None):
+    mesh = obj.data
+    parent_name = ""
+    scale = Vector((1.0, 1.0, 1.0))
+    local_matrix = Matrix.Identity(4)
+    if obj.parent:
+        parent_name, parent_matrix = Get_parent_matrix(obj, node_names)
+        _, _, scale = parent_matrix.decompose()
+        local_matrix = parent_matrix.inverted() @ obj.matrix_world
+        if parent_name == root_name:
+            local_matrix = inverse_rot_mat @ local_matrix
+
+    attributes = mesh.attributes
+    for i, vertex in enumerate(mesh.vertices):
+        name = "{}_point{}".format(obj.name, i)
+        if "sta_name" in attributes and attributes["sta_name"].data[i].value:
+            name = attributes["sta_name"].data[i].value
+        node_type = 0
+        if "sta_node_type" in attributes:
+            node_type = attributes["sta_node_type"].data[i].value
+
+        mat34 = mat34_from_blender(local_matrix @ Matrix.Translation(vertex.co), scale)
+        if "sta_axis_x" in attributes:
+            mat34[0:3] = attributes["sta_axis_x"].data[i].vector
+            mat34[3:6] = attributes["sta_axis_y"].data[i].vector
+            mat34[6:9] = attributes["sta_axis_z"].data[i].vector
+
+        node_name = Get_node_name(name, node_names)
+        nodes[node_name] = Node(
+            type = node_type,
+            name = node_name,
+            root = parent_name,
+            mat34 = mat34
+        )
+        if node_type == 12:
+            emitter = ""
+            if "sta_emitter" in attributes:
+                emitter = attributes["sta_emitter"].data[i].value
+            if len(emitter) == 0:
+                log.warning("Emitter type without emitter set")
+                del nodes[node_name]
+                continue
+            nodes[node_name].emitter = emitter
+
+def Sort_nodes(nodes):
+    # Parents need to be written before their children
+    sorted_nodes = {}
+    def add_node(node):
+        if node.name in sorted_nodes:
+            return
+        if node.root in nodes and node.root != node.name:
+            add_node(nodes[node.root])
+        sorted_nodes[node.name] = node
+    for node in nodes.values():
+        add_node(node)
+    return sorted_nodes
+
+def Add_sod_meshes(nodes, references, built_meshes, object_names):
+    # Geometry that doesn't fit into one mesh goes into child nodes sharing
+    # the space of the node, right after the node itself
+    parts = {}
+    for node_name, meshes in built_meshes:
+        nodes[node_name].mesh = meshes[0]
+        if len(meshes) > 1:
+            log.info("Split %s into %d nodes to fit the sod limits", node_name, len(meshes))
+        parts[node_name] = []
+        for i, mesh in enumerate(meshes[1:]):
+            part_name = "{}_part{}".format(node_name, i + 1)
+            while part_name in nodes or part_name in object_names:
+                part_name += "_"
+            parts[node_name].append(Node(
+                type = 1,
+                name = part_name,
+                root = node_name,
+                mesh = mesh
             ))
 
-    return meshes
+    new_nodes = {}
+    for node_name, node in nodes.items():
+        new_nodes[node_name] = node
+        for part in parts.get(node_name, []):
+            new_nodes[part.name] = part
+
+    # Parts share the texture animation of their node
+    new_references = {}
+    for node_name, reference in references.items():
+        new_references[node_name] = reference
+        for part in parts.get(node_name, []):
+            new_references[part.name] = replace(reference, node = part.name)
+    return new_nodes, new_references
+
+def Can_merge_child(child, mesh_properties):
+    # Only static meshes that end up with the same sod mesh settings, and
+    # only if everything below them can be merged as well
+    if child.type != "MESH" or "sta_merged_nodes" in child or "sta_point_nodes" in child:
+        return False
+    if "node_type" in child and int(child["node_type"]) != 1:
+        return False
+    if child.sta_dynamic_props.animated or child.sta_dynamic_props.texture_animated:
+        return False
+    if not Has_static_transform(child):
+        return False
+    if Get_mesh_properties(child) != mesh_properties:
+        return False
+    return all(Can_merge_child(grandchild, mesh_properties) for grandchild in child.children)
+
+def Get_sorted_children(obj):
+    # Blender doesn't promise any order of the children
+    return sorted(obj.children, key=lambda child: child.name)
+
+def Get_mergeable_children(obj):
+    mesh_properties = Get_mesh_properties(obj)
+    return [child for child in Get_sorted_children(obj) if Can_merge_child(child, mesh_properties)]
+
+def Add_new_sod_nodes(obj, nodes, texture_animated_objects, animated_objects, mesh_builder, root_name, options):
+    if "sta_merged_nodes" in obj:
+        Add_merged_sod_nodes(obj, nodes, options.node_names, options)
+        for child in Get_sorted_children(obj):
+            Add_new_sod_nodes(child, nodes, texture_animated_objects, animated_objects, mesh_builder, root_name, options)
+        return
+
+    if "sta_point_nodes" in obj:
+        Add_point_sod_nodes(obj, nodes, root_name, options.node_names)
+        return
 
-def Add_new_sod_nodes(obj, nodes, texture_animated_objects, animated_objects, root_name, version):
     world_mat = obj.matrix_world
-    obj_name = obj.name.replace(".", "_")
+    obj_name = Get_node_name(obj.name, options.node_names)
     parent_name = ""
     scale = Vector((1.0, 1.0, 1.0))
     if obj.parent:
-        parent_name = obj.parent.name.replace(".", "_")
-        _, _, scale = obj.parent.matrix_world.decompose()
-        world_mat = obj.parent.matrix_world.inverted() @ world_mat
+        parent_name, parent_matrix = Get_parent_matrix(obj, options.node_names)
+        _, _, scale = parent_matrix.decompose()
+        world_mat = parent_matrix.inverted() @ world_mat
         if parent_name == root_name:
             world_mat = inverse_rot_mat @ world_mat
     else:
@@ -421,19 +1607,26 @@ def Add_new_sod_nodes(obj, nodes, texture_animated_objects, animated_objects, ro
                 emitter = str(obj["emitter"])
                 )
         else:
-            print("Emitter type without emitter set")
+            log.warning("Emitter type without emitter set")
     elif node_type == 1:
-        if obj.sta_dynamic_props.texture_animated:
-            texture_animated_objects.append(obj)
+        merged_objects = []
+        if options.merge_children:
+            processed_children = Get_mergeable_children(obj)
+            for child in processed_children:
+                merged_objects.append(child)
+                merged_objects.extend(sorted(child.children_recursive, key=lambda descendant: descendant.name))
+            options.stats["merged_children"] = options.stats.get("merged_children", 0) + len(merged_objects)
 
-        new_mesh = Make_meshes_from_objects([obj], version)[0]
+        # The mesh is built in the background, the node gets it later
+        mesh_builder.add(Make_mesh_job([obj, *merged_objects], obj_name))
         nodes[obj_name] = Node(
             type = node_type,
             name = obj_name,
             root = parent_name,
-            mat34=mat34,
-            mesh=new_mesh
+            mat34=mat34
         )
+        if obj.sta_dynamic_props.texture_animated:
+            texture_animated_objects.append((obj, obj_name))
     else:
         nodes[obj_name] = Node(
             type = node_type,
@@ -445,17 +1638,302 @@ def Add_new_sod_nodes(obj, nodes, texture_animated_objects, animated_objects, ro
     if obj.sta_dynamic_props.animated:
         animated_objects.append(obj)
 
-    # TODO: gather mesh children when merge is enabled
-
-    for child in obj.children:
+    for child in Get_sorted_children(obj):
         if child in processed_children:
             continue
-        Add_new_sod_nodes(child, nodes, texture_animated_objects, animated_objects, root_name, version)
+        Add_new_sod_nodes(child, nodes, texture_animated_objects, animated_objects, mesh_builder, root_name, options)
 
 
-def Export_SOD(file_path, version = 1.8):
+TRANSFORM_PATHS = ("location", "rotation_euler", "rotation_quaternion", "scale")
 
-    new_sod = SOD(version)
+def Get_animation_frames(obj):
+    return range(int(obj["start_frame"]), int(obj["end_frame"]) + 1)
+
+def Has_static_transform(obj):
+    if len(obj.constraints):
+        return False
+    animation_data = obj.animation_data
+    if animation_data is None:
+        return True
+    return animation_data.action is None and len(animation_data.drivers) == 0 and len(animation_data.nla_tracks) == 0
+
+def Can_evaluate_fcurves(obj):
+    # Only plain f-curves on the object itself can be evaluated without
+    # updating the scene. Everything the parent matrix depends on has to
+    # stay the same on every frame
+    if len(obj.constraints) or obj.rotation_mode == "AXIS_ANGLE":
+        return False
+    if obj.parent and obj.parent_type != "OBJECT":
+        return False
+    if (tuple(obj.delta_location) != (0.0, 0.0, 0.0) or
+            tuple(obj.delta_scale) != (1.0, 1.0, 1.0) or
+            tuple(obj.delta_rotation_euler) != (0.0, 0.0, 0.0) or
+            tuple(obj.delta_rotation_quaternion) != (1.0, 0.0, 0.0, 0.0)):
+        return False
+    animation_data = obj.animation_data
+    if animation_data is not None and (len(animation_data.drivers) or len(animation_data.nla_tracks)):
+        return False
+    parent = obj.parent
+    while parent is not None:
+        if not Has_static_transform(parent):
+            return False
+        parent = parent.parent
+    return True
+
+def Euler_matrices(angles, order):
+    # Rotation matrices for every row of euler angles, the first axis of
+    # the order is applied first
+    matrices = np.tile(np.identity(3), (len(angles), 1, 1))
+    for axis in order:
+        index = "XYZ".index(axis)
+        cos = np.cos(angles[:, index])
+        sin = np.sin(angles[:, index])
+        rotation = np.tile(np.identity(3), (len(angles), 1, 1))
+        a, b = [i for i in range(3) if i != index]
+        sign = -1.0 if index == 1 else 1.0
+        rotation[:, a, a] = cos
+        rotation[:, b, b] = cos
+        rotation[:, a, b] = -sin * sign
+        rotation[:, b, a] = sin * sign
+        matrices = rotation @ matrices
+    return matrices
+
+def Quaternion_matrices(quaternions):
+    lengths = np.linalg.norm(quaternions, axis=1)
+    lengths[lengths == 0.0] = 1.0
+    w, x, y, z = (quaternions / lengths[:, None]).T
+    return np.stack((
+        np.stack((1 - 2*(y*y + z*z), 2*(x*y - w*z), 2*(x*z + w*y)), axis=1),
+        np.stack((2*(x*y + w*z), 1 - 2*(x*x + z*z), 2*(y*z - w*x)), axis=1),
+        np.stack((2*(x*z - w*y), 2*(y*z + w*x), 1 - 2*(x*x + y*y)), axis=1)), axis=1)
+
+def Evaluate_basis_matrices(obj, frames):
+    # Evaluates the transform f-curves of the object directly into one
+    # basis matrix per frame
+    rotation_path = "rotation_quaternion" if obj.rotation_mode == "QUATERNION" else "rotation_euler"
+    values = {
+        "location": np.tile(np.array(obj.location), (len(frames), 1)),
+        rotation_path: np.tile(np.array(getattr(obj, rotation_path)), (len(frames), 1)),
+        "scale": np.tile(np.array(obj.scale), (len(frames), 1)),
+    }
+    if obj.animation_data is not None and obj.animation_data.action is not None:
+        for fcurve in obj.animation_data.action.fcurves:
+            if fcurve.mute or fcurve.data_path not in values:
+                continue
+            channel = values[fcurve.data_path]
+            if fcurve.array_index < channel.shape[1]:
+                channel[:, fcurve.array_index] = [fcurve.evaluate(frame) for frame in frames]
+
+    if obj.rotation_mode == "QUATERNION":
+        rotations = Quaternion_matrices(values[rotation_path])
+    else:
+        rotations = Euler_matrices(values[rotation_path], obj.rotation_mode)
+    matrices = np.tile(np.identity(4), (len(frames), 1, 1))
+    matrices[:, :3, :3] = rotations * values["scale"][:, None, :]
+    matrices[:, :3, 3] = values["location"]
+    return matrices
+
+def Mat34s_from_blender(matrices, scale):
+    # mat34_from_blender for a stack of matrices
+    export_matrices = np.array(matrices)
+    export_matrices[:, :3, 3] *= np.array(scale)
+    export_matrices[:, 0, :] *= -1.0
+    export_matrices[:, :, 0] *= -1.0
+    axes = export_matrices[:, :3, :3].transpose(0, 2, 1)
+    lengths = np.linalg.norm(axes, axis=2, keepdims=True)
+    axes = np.divide(axes, lengths, out=np.zeros_like(axes), where=lengths > 0.0)
+    return np.concatenate((axes.reshape(-1, 9), export_matrices[:, :3, 3]), axis=1).tolist()
+
+def World_scales(matrices):
+    # Same as the scale of Matrix.decompose
+    scales = np.linalg.norm(matrices[:, :3, :3], axis=1)
+    scales[np.linalg.det(matrices[:, :3, :3]) < 0.0] *= -1.0
+    return scales
+
+def Get_export_matrix(obj, root_name, node_names=None):
+    world_mat = obj.matrix_world
+    scale = Vector((1.0, 1.0, 1.0))
+    if obj.parent:
+        parent_name, parent_matrix = Get_parent_matrix(obj, node_names)
+        _, _, scale = parent_matrix.decompose()
+        world_mat = parent_matrix.inverted() @ world_mat
+        if parent_name == root_name:
+            world_mat = inverse_rot_mat @ world_mat
+    else:
+        world_mat = Matrix.Identity(4)
+    return mat34_from_blender(world_mat, scale)
+
+def Evaluate_animation(obj, root_name, with_scales, avg_default_scale, node_names=None):
+    frames = Get_animation_frames(obj)
+    basis_matrices = Evaluate_basis_matrices(obj, frames)
+    if obj.parent:
+        parent_name, parent_matrix = Get_parent_matrix(obj, node_names)
+        _, _, scale = parent_matrix.decompose()
+        parent_world = np.array(obj.parent.matrix_world @ obj.matrix_parent_inverse)
+        local = parent_matrix.inverted()
+        if parent_name == root_name:
+            local = inverse_rot_mat @ local
+        matrices = Mat34s_from_blender(np.array(local) @ parent_world @ basis_matrices, scale)
+    else:
+        parent_world = np.identity(4)
+        matrices = [mat34_from_blender(Matrix.Identity(4)) for frame in frames]
+
+    scales = []
+    if with_scales:
+        scales = (average(World_scales(parent_world @ basis_matrices), axis=1) / avg_default_scale).tolist()
+    return matrices, scales
+
+def Bake_animations(animated_objects, root_name, with_scales, stats, node_names=None):
+    # Plain f-curve animations are evaluated directly. Everything else is
+    # sampled in a single sweep over the union of all frame ranges
+    default_scales = {}
+    for obj in animated_objects:
+        _, _, default_scale = obj.matrix_world.decompose()
+        default_scales[obj.name] = average(default_scale)
+
+    baked = {}
+    sampled_objects = []
+    for obj in animated_objects:
+        if Can_evaluate_fcurves(obj):
+            baked[obj.name] = Evaluate_animation(
+                obj, root_name, with_scales, default_scales[obj.name], node_names)
+        else:
+            sampled_objects.append(obj)
+            baked[obj.name] = ([], [])
+
+    frames = sorted(set(chain.from_iterable(Get_animation_frames(obj) for obj in sampled_objects)))
+    if len(frames):
+        scene = bpy.context.scene
+        current_frame = scene.frame_current
+        for frame in frames:
+            scene.frame_set(frame)
+            for obj in sampled_objects:
+                if frame not in Get_animation_frames(obj):
+                    continue
+                matrices, scales = baked[obj.name]
+                matrices.append(Get_export_matrix(obj, root_name, node_names))
+                if with_scales:
+                    _, _, scale = obj.matrix_world.decompose()
+                    scales.append(average(scale) / default_scales[obj.name])
+        scene.frame_set(current_frame)
+
+    stats["evaluated_animations"] = len(animated_objects) - len(sampled_objects)
+    stats["sampled_animations"] = len(sampled_objects)
+    stats["sampled_frames"] = len(frames)
+    return baked
+
+@dataclass
+class Export_options:
+    optimize_vertex_cache: bool = False
+    renumber_vertices: bool = False
+    weld_vertices: bool = False
+    weld_tolerance: float = 0.0001
+    # Bake static mesh children with the same mesh settings into their parent
+    merge_children: bool = False
+    # Threads used to build the meshes, 0 uses all cores
+    max_workers: int = 0
+    # Reuse meshes of earlier exports when nothing they depend on changed
+    use_cache: bool = True
+    # Copy unchanged meshes from the files that are overwritten
+    splice: bool = False
+    # Keep vertices, tcs and faces of the built meshes next to their
+    # encoded data, and don't share meshes with the cache
+    keep_mesh_data: bool = False
+    # Node names by object name for objects that don't just get their dots
+    # replaced, the batch export sets them for every ship
+    node_names: dict = field(default_factory=dict)
+    # Set from another thread to stop a running export
+    cancel: threading.Event = field(default_factory=threading.Event)
+    stats: dict = field(default_factory=dict)
+
+def Get_memory_usage():
+    # Current resident memory of the blender process in bytes, None where
+    # it can't be queried
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError, IndexError):
+        pass
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD),
+                        ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t),
+                        ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize
+    except (ImportError, AttributeError, OSError):
+        pass
+    return None
+
+class Memory_sampler:
+    # Samples the memory use on a thread while an export runs. The process
+    # peak never goes down, the rise over the start belongs to this export
+    INTERVAL = 0.01
+
+    def __init__(self):
+        self.start_usage = Get_memory_usage()
+        self.peak_usage = self.start_usage
+        self.stopped = threading.Event()
+        self.thread = None
+        if self.start_usage is not None:
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+
+    def sample(self):
+        while not self.stopped.wait(self.INTERVAL):
+            self.peak_usage = max(self.peak_usage, Get_memory_usage())
+
+    def stop(self):
+        # Returns how far the memory use rose above the start in bytes,
+        # None where it can't be measured
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.start_usage is None:
+            return None
+        self.peak_usage = max(self.peak_usage, Get_memory_usage())
+        return self.peak_usage - self.start_usage
+
+def Add_timing(stats, phase, start):
+    seconds = time.perf_counter() - start
+    timings = stats.setdefault("timings", {})
+    timings[phase] = timings.get(phase, 0.0) + seconds
+    log.debug("%s took %.3fs", phase, seconds)
+
+class Phase_timer:
+    # Adds the time between start and stop to a phase, for work that is
+    # spread over several calls like the steps of an import
+    def __init__(self, stats):
+        self.stats = stats
+        self.phase = None
+        self.start_time = 0.0
+
+    def start(self, phase):
+        self.phase = phase
+        self.start_time = time.perf_counter()
+
+    def stop(self):
+        if self.phase is not None:
+            Add_timing(self.stats, self.phase, self.start_time)
+            self.phase = None
+
+def Get_export_materials():
+    materials = {}
     for mat in bpy.data.materials:
         if not mat.use_nodes:
             continue
@@ -471,7 +1949,7 @@ def Export_SOD(file_path, version = 1.8):
             continue
 
         if bpy.app.version >= (4, 0, 0):
-            new_sod.materials[mat_node.node_tree.name] = Material(
+            materials[mat_node.node_tree.name] = Material(
                 mat_node.node_tree.name,
                 tuple(mat_node.node_tree.interface.items_tree["Ambient Color"].default_value[:3]),
                 tuple(mat_node.node_tree.interface.items_tree["Diffuse Color"].default_value[:3]),
@@ -480,7 +1958,7 @@ def Export_SOD(file_path, version = 1.8):
                 mat_node.node_tree.interface.items_tree["Lighting Model"].default_value
             )
         else:
-            new_sod.materials[mat_node.node_tree.name] = Material(
+            materials[mat_node.node_tree.name] = Material(
                 mat_node.node_tree.name,
                 tuple(mat_node.node_tree.inputs["Ambient Color"].default_value[:3]),
                 tuple(mat_node.node_tree.inputs["Diffuse Color"].default_value[:3]),
@@ -488,72 +1966,328 @@ def Export_SOD(file_path, version = 1.8):
                 mat_node.node_tree.inputs["Specular Power"].default_value,
                 mat_node.node_tree.inputs["Lighting Model"].default_value
             )
+    # Sorted, so the same scene always gives the same file
+    return dict(sorted(materials.items()))
 
-    root_name = "root"
-    if root_name not in bpy.context.scene.objects:
-        root_name = "Scene Root"
-        if root_name not in bpy.context.scene.objects:
-            new_sod.to_file(file_path)
-            raise Exception(
-                "No root object found. Exported materials only. Valid root "
-                "names are 'root' or 'Scene Root'")
-    
+def Get_root_name():
+    for root_name in ("root", "Scene Root"):
+        if root_name in bpy.context.scene.objects:
+            return root_name
+    return None
+
+class Export_cancelled(Exception):
+    pass
+
+def Check_cancelled(options):
+    if options.cancel.is_set():
+        raise Export_cancelled("Export cancelled")
+
+def Start_export(new_sod, root_name, versions, options, splice_meshes=None):
+    # Everything that needs blender data, so it runs on the main thread.
+    # Meshes are built in the background in the meantime. Everything is
+    # gathered once for all versions, version specific differences are
+    # left to the encoding and Get_target_sod
     texture_animated_objects = []
     animated_objects = []
-    Add_new_sod_nodes(
-        bpy.context.scene.objects[root_name],
-        new_sod.nodes,
-        texture_animated_objects,
-        animated_objects,
-        root_name,
-        version)
-
-    # add animations
-    for obj in animated_objects[::-1]:
-        matrices = []
-        scales = []
-        _, _, default_scale = obj.matrix_world.decompose()
-        avg_default_scale = average(default_scale)
-        for i in range(int(obj["start_frame"]), int(obj["end_frame"]) + 1):
-            bpy.context.scene.frame_set(i)
-            world_mat = obj.matrix_world
-            scale = Vector((1.0, 1.0, 1.0))
-            if obj.parent:
-                _, _, scale = obj.parent.matrix_world.decompose()
-                world_mat = obj.parent.matrix_world.inverted() @ world_mat
-                if obj.parent.name == root_name:
-                    world_mat = inverse_rot_mat @ world_mat
-            else:
-                world_mat = Matrix.Identity(4)
-
-            mat34 = mat34_from_blender(world_mat, scale)
-            matrices.append(mat34)
+    root = bpy.context.scene.objects[root_name]
+    root_name = Get_node_name(root_name, options.node_names)
+    mesh_builder = Mesh_builder(versions, options, splice_meshes)
+    try:
+        start = time.perf_counter()
+        Add_new_sod_nodes(
+            root,
+            new_sod.nodes,
+            texture_animated_objects,
+            animated_objects,
+            mesh_builder,
+            root_name,
+            options)
+        Add_timing(options.stats, "extraction", start)
 
-            if version == 1.93:
-                _, _, scale = obj.matrix_world.decompose()
-                scales.append(average(scale) / avg_default_scale)
-        
-        obj_name = obj.name.replace(".", "_")
-        new_sod.channels[obj_name] = [Animation_channel(
-            name = obj_name,
-            length = obj["length"],
-            matrices=matrices
-        )]
-        if version == 1.93:
-            new_sod.channels[obj_name].append(Animation_channel(
+        # add animations
+        start = time.perf_counter()
+        with_scales = 1.93 in versions
+        baked = Bake_animations(animated_objects, root_name, with_scales, options.stats, options.node_names)
+        for obj in animated_objects[::-1]:
+            matrices, scales = baked[obj.name]
+            obj_name = Get_node_name(obj.name, options.node_names)
+            new_sod.channels[obj_name] = [Animation_channel(
                 name = obj_name,
                 length = obj["length"],
-                scales=scales
-            ))
+                matrices=matrices
+            )]
+            if with_scales:
+                new_sod.channels[obj_name].append(Animation_channel(
+                    name = obj_name,
+                    length = obj["length"],
+                    scales=scales
+                ))
 
-    # add references
-    for obj in texture_animated_objects:
-        new_sod.references[obj.name.replace(".", "_")] = Animation_reference(
-            type = obj["ref_type"],
-            node = obj.name.replace(".", "_"),
-            anim = obj["ref_animation"],
-            offset= obj["ref_offset"]
-        )
+        # add references
+        for obj, node_name in texture_animated_objects:
+            new_sod.references[node_name] = Animation_reference(
+                type = obj["ref_type"],
+                node = node_name,
+                anim = obj["ref_animation"],
+                offset= obj["ref_offset"]
+            )
+        Add_timing(options.stats, "animations", start)
+    except BaseException:
+        mesh_builder.close()
+        mesh_builder.memory.stop()
+        raise
+    return mesh_builder, set(obj.name for obj in bpy.data.objects)
+
+def Finish_export(new_sod, mesh_builder, object_names, options):
+    # Doesn't touch blender data, so it can run on a worker thread. Returns
+    # the nodes holding the meshes of every cache key
+    start = time.perf_counter()
+    try:
+        built_meshes = mesh_builder.finish()
+    finally:
+        mesh_builder.close()
+    Check_cancelled(options)
+    new_sod.nodes, new_sod.references = Add_sod_meshes(
+        new_sod.nodes, new_sod.references, built_meshes, object_names)
+    new_sod.nodes = Sort_nodes(new_sod.nodes)
+    new_sod.channels = dict(sorted(new_sod.channels.items()))
+    new_sod.references = dict(sorted(new_sod.references.items()))
+
+    mesh_node_names = {id(node.mesh): node.name for node in new_sod.nodes.values() if node.mesh is not None}
+    mesh_nodes = {Get_splice_key(key): [mesh_node_names[id(mesh)] for mesh in meshes]
+                  for key, (_, meshes) in zip(mesh_builder.keys, built_meshes)}
+    Add_timing(options.stats, "encoding", start)
+    return mesh_nodes
+
+def Add_export_nodes(new_sod, root_name, versions, options):
+    mesh_builder, object_names = Start_export(new_sod, root_name, versions, options)
+    try:
+        Finish_export(new_sod, mesh_builder, object_names, options)
+    finally:
+        options.stats["peak_memory"] = mesh_builder.memory.stop()
+
+def Get_target_sod(sod, version):
+    # Only Armada II knows scale channels
+    channels = {}
+    for name, channel_list in sod.channels.items():
+        channels[name] = [channel for channel in channel_list
+                          if version == 1.93 or not len(channel.scales)]
+    return SOD(version, sod.materials, sod.nodes, channels, sod.references)
+
+def Start_export_targets(targets, options):
+    # Main thread part of exporting the scene once for several
+    # (file path, version) targets
+    versions = tuple(sorted(set(version for _, version in targets)))
+
+    start = time.perf_counter()
+    new_sod = SOD(versions[-1])
+    new_sod.materials = Get_export_materials()
+    Add_timing(options.stats, "materials", start)
+
+    root_name = Get_root_name()
+    if root_name is None:
+        for file_path, version in targets:
+            Get_target_sod(new_sod, version).to_file(file_path)
+        raise Exception(
+            "No root object found. Exported materials only. Valid root "
+            "names are 'root' or 'Scene Root'")
+
+    splice_meshes = Load_splice_meshes(targets) if options.splice else None
+    mesh_builder, object_names = Start_export(new_sod, root_name, versions, options, splice_meshes)
+    return new_sod, mesh_builder, object_names
+
+def Finish_export_targets(new_sod, mesh_builder, object_names, targets, options):
+    # Can run on a worker thread
+    try:
+        mesh_nodes = Finish_export(new_sod, mesh_builder, object_names, options)
+
+        # Node data is streamed into the file, node by node
+        start = time.perf_counter()
+        for file_path, version in targets:
+            Check_cancelled(options)
+            Get_target_sod(new_sod, version).to_file(file_path)
+            if options.splice:
+                Write_splice_record(file_path, version, mesh_nodes)
+        Add_timing(options.stats, "write", start)
+    finally:
+        options.stats["peak_memory"] = mesh_builder.memory.stop()
+
+def Export_SOD_targets(targets, options = None):
+    if options is None:
+        options = Export_options()
+    new_sod, mesh_builder, object_names = Start_export_targets(targets, options)
+    Finish_export_targets(new_sod, mesh_builder, object_names, targets, options)
+
+def Export_SOD(file_path, version = 1.8, options = None):
+    Export_SOD_targets([(file_path, version)], options)
+
+def Get_batch_exports():
+    # Every scene and collection that directly holds a root object, as
+    # (sod name, scene, root object). Scenes go first, so a single ship file
+    # is named after its scene
+    sources = [(scene.name, scene.collection) for scene in bpy.data.scenes]
+    sources += [(collection.name, collection) for collection in bpy.data.collections]
+    exports = []
+    names = set()
+    for name, collection in sources:
+        roots = [obj for obj in collection.objects
+                 if obj.parent is None and Strip_name_suffix(obj.name) in ("root", "Scene Root")]
+        if any(root == export[2] for export in exports for root in roots):
+            continue
+        if len(roots) != 1:
+            if len(roots) > 1:
+                log.warning("Skipped %s because it holds more than one root object", name)
+            continue
+        scene = next((scene for scene in bpy.data.scenes if roots[0].name in scene.objects), None)
+        if scene is None:
+            log.warning("Skipped %s because it isn't part of any scene", name)
+            continue
+        name = Strip_name_suffix(name)
+        if name in names:
+            log.warning("Skipped %s because another ship is exported as %s", collection.name, name)
+            continue
+        names.add(name)
+        exports.append((name, scene, roots[0]))
+    return exports
+
+def Start_batch_export(scene, root, targets, materials, options):
+    versions = tuple(sorted(set(version for _, version in targets)))
+    new_sod = SOD(versions[-1])
+    new_sod.materials = materials
+
+    splice_meshes = Load_splice_meshes(targets) if options.splice else None
+    # Shares stats and cancel event with the given options
+    options = replace(options, node_names=Get_stripped_node_names(root))
+    if scene == bpy.context.scene:
+        mesh_builder, object_names = Start_export(new_sod, root.name, versions, options, splice_meshes)
+    else:
+        with bpy.context.temp_override(scene=scene, view_layer=scene.view_layers[0]):
+            mesh_builder, object_names = Start_export(
+                new_sod, root.name, versions, options, splice_meshes)
+    return new_sod, mesh_builder, object_names
+
+def Add_batch_stats(stats, ship_stats):
+    timings = stats.setdefault("timings", {})
+    for phase, seconds in ship_stats.pop("timings", {}).items():
+        timings[phase] = timings.get(phase, 0.0) + seconds
+    peak_memory = ship_stats.pop("peak_memory", None)
+    if peak_memory is not None:
+        stats["peak_memory"] = max(stats.get("peak_memory", 0), peak_memory)
+    Merge_stats(stats, ship_stats)
+
+def Export_SOD_batch(batch, options = None):
+    # Exports every (scene, root object, targets) entry of the batch. The
+    # objects of the next ship are gathered while the meshes of the previous
+    # one are built and written on a worker thread. Materials are looked up
+    # once for all ships and meshes shared between ships come from the
+    # export cache. Returns the error of every ship, None if it was exported
+    if options is None:
+        options = Export_options()
+
+    start = time.perf_counter()
+    materials = Get_export_materials()
+    Add_timing(options.stats, "materials", start)
+
+    errors = [None] * len(batch)
+    def wait(pending):
+        i, future, ship_options = pending
+        try:
+            future.result()
+        except Export_cancelled:
+            raise
+        except Exception as e:
+            errors[i] = e
+        Add_batch_stats(options.stats, ship_options.stats)
+
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        pending = None
+        for i, (scene, root, targets) in enumerate(batch):
+            Check_cancelled(options)
+            ship_options = replace(options, stats={})
+            try:
+                export_job = Start_batch_export(scene, root, targets, materials, ship_options)
+            except Export_cancelled:
+                raise
+            except Exception as e:
+                errors[i] = e
+                continue
+            if pending is not None:
+                wait(pending)
+            pending = (i, writer.submit(Finish_export_targets, *export_job, targets, ship_options), ship_options)
+        if pending is not None:
+            wait(pending)
+    return errors
+
+def Analyze_SOD(version = 1.8, options = None):
+    # Runs the export without writing a file and returns how close every
+    # mesh node gets to the sod limits
+    if options is None:
+        options = Export_options()
+    # The counts need the mesh data, cached meshes only have their encoding
+    options.keep_mesh_data = True
+    options.use_cache = False
+
+    start = time.perf_counter()
+    new_sod = SOD(version)
+    new_sod.materials = Get_export_materials()
+    Add_timing(options.stats, "materials", start)
+
+    root_name = Get_root_name()
+    if root_name is None:
+        raise Exception("No root object found. Valid root names are 'root' or 'Scene Root'")
+
+    Add_export_nodes(new_sod, root_name, (version,), options)
+
+    start = time.perf_counter()
+    nodes = []
+    draw_states = set()
+    for node in new_sod.nodes.values():
+        if node.mesh is None:
+            continue
+        mesh = node.mesh
+        group_faces = [len(group.faces) for group in mesh.groups]
+        for group in mesh.groups:
+            draw_states.add((group.material, mesh.texture, mesh.cull_type))
+        row = {
+            "name": node.name,
+            "verts": len(mesh.verts),
+            "tcs": len(mesh.tcs),
+            "faces": sum(group_faces),
+            "max_group_faces": max(group_faces, default=0),
+            "draw_calls": len(mesh.groups),
+            "bytes": len(node.to_bytearray(version)),
+        }
+        row["usage"] = max(row["verts"], row["tcs"], row["max_group_faces"]) / MAX_ELEMENTS
+        nodes.append(row)
+
+    totals = {key: sum(row[key] for row in nodes)
+              for key in ("verts", "tcs", "faces", "draw_calls", "bytes")}
+    totals["nodes"] = len(new_sod.nodes)
+    totals["mesh_nodes"] = len(nodes)
+    totals["draw_states"] = len(draw_states)
+    totals["file_size"] = len(new_sod.to_bytearray())
+    Add_timing(options.stats, "analysis", start)
+
+    return {
+        "nodes": nodes,
+        "totals": totals,
+        "timings": dict(options.stats["timings"]),
+    }
 
-    new_sod.to_file(file_path)
-    return
\ No newline at end of file
+def Format_analysis(analysis):
+    # Lines of the analysis table
+    lines = ["{:<32} {:>7} {:>7} {:>7} {:>6} {:>9} {:>6}".format(
+        "Node", "Verts", "Tcs", "Faces", "Draws", "Bytes", "Limit")]
+    for row in analysis["nodes"]:
+        lines.append("{:<32} {:>7} {:>7} {:>7} {:>6} {:>9} {:>5.0f}%".format(
+            row["name"][:32], row["verts"], row["tcs"], row["faces"],
+            row["draw_calls"], row["bytes"], 100.0 * row["usage"]))
+    totals = analysis["totals"]
+    lines.append("{:<32} {:>7} {:>7} {:>7} {:>6} {:>9}".format(
+        "Total", totals["verts"], totals["tcs"], totals["faces"],
+        totals["draw_calls"], totals["bytes"]))
+    lines.append("File size: {} bytes, {} distinct material, texture and cull combinations".format(
+        totals["file_size"], totals["draw_states"]))
+    for phase, seconds in analysis["timings"].items():
+        lines.append("{:<12} {:.3f}s".format(phase, seconds))
+    return lines
@@ -24,9 +24,17 @@
 
 from __future__ import annotations
 from dataclasses import dataclass, field
+from itertools import chain
+import hashlib
+import logging
+import os
 import struct
 
+log = logging.getLogger(__name__)
+
 SUPPORTED_VERSIONS = (1.4, 1.5, 1.6, 1.7, 1.8, 1.9, 1.91, 1.92, 1.93)
+# Vertex, texture coordinate and face counts are stored as uint16
+MAX_ELEMENTS = 65535
 
 @dataclass
 class Identifier:
@@ -128,8 +136,9 @@ class Vertex_group:
         array = bytearray()
         array += struct.pack("<H", len(self.faces))
         array += Identifier(self.material).to_bytearray()
-        for face in self.faces:
-            array += face.to_bytearray()
+        # Same layout as Face.to_bytearray, packed in one go
+        array += struct.pack("<{}H".format(len(self.faces) * 6), *chain.from_iterable(
+            chain.from_iterable(zip(face.indices, face.tc_indices)) for face in self.faces))
         return array
 
 @dataclass
@@ -147,6 +156,9 @@ class Mesh:
     use_heightmap: bool = True
     assimilation_texture: str = ""
 
+    # Already encoded mesh data by sod version, filled by the exporter
+    encoded: dict[float, bytes] = field(default_factory=dict, repr=False, compare=False)
+
     @classmethod
     def from_file(cls, file, sod_version) -> Mesh:
         self = cls()
@@ -198,6 +210,9 @@ class Mesh:
         return self
     
     def to_bytearray(self, sod_version = 1.8) -> bytearray:
+        if sod_version in self.encoded:
+            return bytearray(self.encoded[sod_version])
+
         array = bytearray()
         if sod_version >= 1.7:
             if sod_version <= 1.8 and self.material == "opaque":
@@ -235,10 +250,8 @@ class Mesh:
         array += struct.pack("<H", len(self.verts))
         array += struct.pack("<H", len(self.tcs))
         array += struct.pack("<H", len(self.groups))
-        for vert in self.verts:
-            array += struct.pack("<3f", *vert)
-        for tc in self.tcs:
-            array += struct.pack("<2f", *tc)
+        array += struct.pack("<{}f".format(len(self.verts) * 3), *chain.from_iterable(self.verts))
+        array += struct.pack("<{}f".format(len(self.tcs) * 2), *chain.from_iterable(self.tcs))
         for group in self.groups:
             array += group.to_bytearray()
         array += struct.pack("<b", self.cull_type)
@@ -267,7 +280,7 @@ class Node:
         elif self.type == 1:
             self.mesh = Mesh.from_file(file, sod_version)
         elif self.type not in VALID_NODE_TYPES:
-            print("Error in file. Incorrect node type found. Node:", self.name, "Type:", self.type)
+            log.error("Error in file. Incorrect node type found. Node: %s Type: %s", self.name, self.type)
         return self
     
     def to_bytearray(self, sod_version = 1.8) -> bytearray:
@@ -377,7 +390,7 @@ class SOD:
 
             version = file.read(4)
             self.version = round(struct.unpack("<f", version)[0], 2)
-            print("File:", file_path.replace("\\", "/").rsplit("/", 1)[1], self.version)
+            log.info("File: %s %s", file_path.replace("\\", "/").rsplit("/", 1)[-1], self.version)
 
             if self.version in (1.4, 1.5, 1.6):
                 whatever = struct.unpack("<H", file.read(2))[0]
@@ -392,19 +405,19 @@ class SOD:
                 raise Exception("Not a supported sod file. File version was {}".format(self.version))
 
             num_mats = struct.unpack("<H", file.read(2))[0]
-            print("Materials:", num_mats)
+            log.debug("Materials: %d", num_mats)
             for i in range(num_mats):
                 material = Material.from_file(file, self.version)
                 materials[material.name] = material
 
             num_nodes = struct.unpack("<H", file.read(2))[0]
-            print("Nodes:", num_nodes)
+            log.debug("Nodes: %d", num_nodes)
             for i in range(num_nodes):
                 node = Node.from_file(file, self.version)
                 nodes[node.name] = node
 
             num_animation_channels = struct.unpack("<H", file.read(2))[0]
-            print("Mesh Animations", num_animation_channels)
+            log.debug("Mesh Animations: %d", num_animation_channels)
             for i in range(num_animation_channels):
                 channel = Animation_channel.from_file(file)
                 if channel.name in channels:
@@ -420,7 +433,7 @@ class SOD:
                 return self
 
             num_animation_references = struct.unpack("<H", file.read(2))[0]
-            print("Texture Animations", num_animation_references)
+            log.debug("Texture Animations: %d", num_animation_references)
             for i in range(num_animation_references):
                 reference = Animation_reference.from_file(file, self.version)
                 references[reference.node] = reference
@@ -431,7 +444,9 @@ class SOD:
         self.references = references
         return self
     
-    def to_file(self, file_path):
+    def to_chunks(self):
+        # Yields the file piece by piece, so it can be written without
+        # holding all of it in memory
 
         if self.version not in SUPPORTED_VERSIONS:
             raise Exception(
@@ -449,9 +464,12 @@ class SOD:
         for mat in self.materials.values():
             array += mat.to_bytearray(self.version)
         array += struct.pack("<H", len(self.nodes))
+        yield array
+
         for node in self.nodes.values():
-            array += node.to_bytearray(self.version)
+            yield node.to_bytearray(self.version)
 
+        array = bytearray()
         channel_count = 0
         for channel_list in self.channels.values():
             channel_count += len(channel_list)
@@ -464,7 +482,160 @@ class SOD:
             array += struct.pack("<H", len(self.references))
             for ref in self.references.values():
                 array += ref.to_bytearray(self.version)
+        yield array
+
+    def to_bytearray(self) -> bytearray:
+        array = bytearray()
+        for chunk in self.to_chunks():
+            array += chunk
+        return array
+
+    def to_file(self, file_path):
+        # Returns the sha1 of the written data. An existing file with the
+        # same content is left untouched
+        chunks = self.to_chunks()
+        # Invalid versions fail here, before the file is touched
+        header = next(chunks)
+        # Written next to the old file and swapped in at the end, so the old
+        # file stays intact if anything goes wrong
+        temp_path = file_path + ".tmp"
+        digest = hashlib.sha1()
+        size = 0
+        try:
+            with open(temp_path, "wb") as file:
+                for chunk in chain((header,), chunks):
+                    file.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            if (os.path.isfile(file_path) and os.path.getsize(file_path) == size and
+                    hash_file(file_path) == digest.hexdigest()):
+                os.remove(temp_path)
+            else:
+                os.replace(temp_path, file_path)
+        except BaseException:
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+            raise
+        return digest.hexdigest()
+
+def hash_file(file_path):
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Scanning a file only reads names and counts and seeks over everything
+# else, so the byte ranges of huge files are found without parsing them
+def skip_identifier(file):
+    length = struct.unpack("<H", file.read(2))[0]
+    file.seek(length, 1)
+
+def skip_mesh(file, sod_version):
+    if sod_version >= 1.7:
+        skip_identifier(file)
+    num_textures = 1
+    if sod_version >= 1.93:
+        num_textures = struct.unpack("<2I", file.read(8))[1]
+    skip_identifier(file)
+
+    if sod_version == 1.91:
+        file.seek(2, 1)
+    elif sod_version == 1.92:
+        skip_identifier(file)
+        file.seek(2, 1)
+    elif sod_version >= 1.93:
+        file.seek(4, 1)
+        if num_textures == 2:
+            skip_identifier(file)
+            file.seek(4, 1)
+        skip_identifier(file)
+        file.seek(2, 1)
+
+    num_vertices, num_tcs, num_groups = struct.unpack("<3H", file.read(6))
+    file.seek(num_vertices * 12 + num_tcs * 8, 1)
+    for i in range(num_groups):
+        num_faces = struct.unpack("<H", file.read(2))[0]
+        skip_identifier(file)
+        file.seek(num_faces * 12, 1)
+    file.seek(1, 1)
+    unknown = struct.unpack("<H", file.read(2))[0]
+    file.seek(unknown * 2, 1)
+
+@dataclass
+class SOD_index:
+    # Byte ranges (start, end) of everything in a sod file
+    file_path: str = ""
+    version: float = 0.0
+    size: int = 0
+    materials: dict[str, tuple[int, int]] = field(default_factory=dict)
+    nodes: dict[str, tuple[int, int]] = field(default_factory=dict)
+    # Only the mesh data of mesh nodes, without the node header
+    meshes: dict[str, tuple[int, int]] = field(default_factory=dict)
+    channels: list[tuple[str, tuple[int, int]]] = field(default_factory=list)
+    references: dict[str, tuple[int, int]] = field(default_factory=dict)
+
+    @classmethod
+    def from_file_path(cls, file_path) -> SOD_index:
+        self = cls(file_path)
+        with open(file_path, "rb") as file:
+            ident = file.read(10).decode()
+            if ident != "Storm3D_SW" and ident != "StarTrekDB":
+                raise Exception("Not a valid sod file. File ident was {}. Expected 'Storm3D_SW' or 'StarTrekDB'".format(ident))
+            self.version = round(struct.unpack("<f", file.read(4))[0], 2)
+            if self.version in (1.4, 1.5, 1.6):
+                for i in range(struct.unpack("<H", file.read(2))[0]):
+                    skip_identifier(file)
+                    skip_identifier(file)
+                    file.seek(7, 1)
+            elif self.version not in SUPPORTED_VERSIONS:
+                raise Exception("Not a supported sod file. File version was {}".format(self.version))
+
+            for i in range(struct.unpack("<H", file.read(2))[0]):
+                start = file.tell()
+                name = Identifier.from_file(file).name
+                file.seek(42 if self.version >= 1.9 else 41, 1)
+                self.materials[name] = (start, file.tell())
+
+            for i in range(struct.unpack("<H", file.read(2))[0]):
+                start = file.tell()
+                node_type = struct.unpack("<H", file.read(2))[0]
+                name = Identifier.from_file(file).name
+                skip_identifier(file)
+                file.seek(48, 1)
+                if node_type == 12:
+                    skip_identifier(file)
+                elif node_type == 1:
+                    mesh_start = file.tell()
+                    skip_mesh(file, self.version)
+                    self.meshes[name] = (mesh_start, file.tell())
+                self.nodes[name] = (start, file.tell())
+
+            for i in range(struct.unpack("<H", file.read(2))[0]):
+                start = file.tell()
+                name = Identifier.from_file(file).name
+                num_keyframes, _, animation_type = struct.unpack("<HfH", file.read(8))
+                file.seek(num_keyframes * (4 if animation_type == 5 else 48), 1)
+                self.channels.append((name, (start, file.tell())))
+
+            if self.version not in (1.4, 1.5):
+                for i in range(struct.unpack("<H", file.read(2))[0]):
+                    start = file.tell()
+                    file.seek(1, 1)
+                    node = Identifier.from_file(file).name
+                    skip_identifier(file)
+                    if self.version >= 1.8:
+                        file.seek(4, 1)
+                    self.references[node] = (start, file.tell())
+            self.size = file.tell()
+        return self
 
-        with open(file_path, "wb") as file:
-            file.write(array)
-        return
+    def read_meshes(self, names) -> dict[str, bytes]:
+        # Reads the raw mesh data of the nodes in file order
+        meshes = {}
+        with open(self.file_path, "rb") as file:
+            for name in sorted(names, key=lambda name: self.meshes[name][0]):
+                start, end = self.meshes[name]
+                file.seek(start)
+                meshes[name] = file.read(end - start)
+        return meshes
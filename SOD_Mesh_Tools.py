@@ -0,0 +1,276 @@
+# ##### BEGIN MIT LICENSE BLOCK #####
+#
+# Copyright (c) 2025 SomaZ
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# ##### END MIT LICENSE BLOCK #####
+
+# Mesh processing for the sod exporter. Only depends on numpy, so it can
+# run outside of blender and on worker threads.
+
+import numpy as np
+from itertools import product
+from .SOD import MAX_ELEMENTS
+
+def part_1_by_2(values):
+    # Spreads the lower 10 bits of every value to every third bit
+    values = values.astype(np.uint32) & 0x000003ff
+    values = (values ^ (values << 16)) & 0xff0000ff
+    values = (values ^ (values << 8)) & 0x0300f00f
+    values = (values ^ (values << 4)) & 0x030c30c3
+    values = (values ^ (values << 2)) & 0x09249249
+    return values
+
+def morton_order(points):
+    if len(points) == 0:
+        return np.zeros(0, dtype=np.int64)
+    minimum = points.min(axis=0)
+    extent = np.maximum(points.max(axis=0) - minimum, 1e-12)
+    cells = ((points - minimum) / extent * 1023.0).astype(np.uint32)
+    codes = part_1_by_2(cells[:, 0]) | (part_1_by_2(cells[:, 1]) << 1) | (part_1_by_2(cells[:, 2]) << 2)
+    return np.argsort(codes, kind="stable")
+
+def partition_triangles(corner_positions, position_ids, tc_ids, group_ids, max_elements=MAX_ELEMENTS):
+    # Splits triangles into chunks that each fit the uint16 limits of a sod
+    # mesh. Triangles are visited once along a morton curve of their
+    # centroids, so every chunk stays spatially compact. Returns the chunk
+    # index of every triangle and the number of chunks
+    num_triangles = len(group_ids)
+    chunks = np.zeros(num_triangles, dtype=np.int32)
+    if num_triangles == 0:
+        return chunks, 1
+
+    position_ids = position_ids.reshape(-1, 3)
+    tc_ids = tc_ids.reshape(-1, 3)
+    # Everything fits, no need to walk the triangles
+    if (len(np.unique(position_ids)) <= max_elements and
+            len(np.unique(tc_ids)) <= max_elements and
+            np.bincount(group_ids).max() <= max_elements):
+        return chunks, 1
+
+    centroids = corner_positions.reshape(-1, 3, 3).mean(axis=1)
+    order = morton_order(centroids)
+    position_list = position_ids[order].tolist()
+    tc_list = tc_ids[order].tolist()
+    group_list = group_ids[order].tolist()
+
+    # Stamps hold the chunk an id was last used in, so nothing needs to be
+    # cleared when a new chunk starts
+    position_stamp = [-1] * (int(position_ids.max()) + 1)
+    tc_stamp = [-1] * (int(tc_ids.max()) + 1)
+    chunk = 0
+    num_positions = 0
+    num_tcs = 0
+    group_faces = {}
+    chunk_list = [0] * num_triangles
+
+    for i, (positions, tcs, group) in enumerate(zip(position_list, tc_list, group_list)):
+        new_positions = set(index for index in positions if position_stamp[index] != chunk)
+        new_tcs = set(index for index in tcs if tc_stamp[index] != chunk)
+        if (num_positions + len(new_positions) > max_elements or
+                num_tcs + len(new_tcs) > max_elements or
+                group_faces.get(group, 0) + 1 > max_elements):
+            chunk += 1
+            num_positions = 0
+            num_tcs = 0
+            group_faces = {}
+            new_positions = set(positions)
+            new_tcs = set(tcs)
+
+        for index in new_positions:
+            position_stamp[index] = chunk
+        for index in new_tcs:
+            tc_stamp[index] = chunk
+        num_positions += len(new_positions)
+        num_tcs += len(new_tcs)
+        group_faces[group] = group_faces.get(group, 0) + 1
+        chunk_list[i] = chunk
+
+    chunks[order] = chunk_list
+    return chunks, chunk + 1
+
+# Vertex cache optimization after Tom Forsyth's "Linear-Speed Vertex Cache
+# Optimisation"
+VERTEX_CACHE_SIZE = 32
+CACHE_DECAY_POWER = 1.5
+LAST_TRIANGLE_SCORE = 0.75
+VALENCE_BOOST_SCALE = 2.0
+VALENCE_BOOST_POWER = 0.5
+
+def average_cache_miss_ratio(faces, cache_size=VERTEX_CACHE_SIZE):
+    # Simulates a fifo post transform cache and returns misses per triangle
+    if len(faces) == 0:
+        return 0.0
+    cache = []
+    cached = set()
+    misses = 0
+    for vertex in np.asarray(faces).ravel().tolist():
+        if vertex in cached:
+            continue
+        misses += 1
+        cache.append(vertex)
+        cached.add(vertex)
+        if len(cache) > cache_size:
+            cached.discard(cache.pop(0))
+    return misses / len(faces)
+
+def optimize_vertex_cache(faces):
+    # Returns the new order of the faces. Every emitted triangle changes the
+    # scores of the next candidates, so the greedy walk itself stays a loop.
+    # Triangle scores are summed only for the few candidates next to the
+    # cache instead of being kept up to date for every triangle
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    num_faces = len(faces)
+    if num_faces < 2:
+        return np.arange(num_faces)
+    _, vertices = np.unique(faces.ravel(), return_inverse=True)
+    vertices = vertices.reshape(-1)
+    num_vertices = int(vertices.max()) + 1
+
+    # Triangles not emitted yet of every vertex. Degenerate triangles are
+    # listed once per corner, just like they count towards the valence
+    valence = np.bincount(vertices, minlength=num_vertices)
+    offsets = np.zeros(num_vertices + 1, dtype=np.int64)
+    np.cumsum(valence, out=offsets[1:])
+    corner_triangles = (np.argsort(vertices, kind="stable") // 3).tolist()
+    offsets = offsets.tolist()
+    adjacency = [corner_triangles[offsets[i]:offsets[i + 1]] for i in range(num_vertices)]
+
+    # Score tables, indexed by cache position + 1 and remaining valence
+    cache_scores = [0.0, LAST_TRIANGLE_SCORE, LAST_TRIANGLE_SCORE, LAST_TRIANGLE_SCORE]
+    positions = np.arange(3, VERTEX_CACHE_SIZE)
+    cache_scores += ((1.0 - (positions - 3) / (VERTEX_CACHE_SIZE - 3)) ** CACHE_DECAY_POWER).tolist()
+    valence_scores = np.zeros(int(valence.max()) + 1)
+    valence_scores[1:] = VALENCE_BOOST_SCALE * np.arange(1, len(valence_scores)) ** -VALENCE_BOOST_POWER
+
+    triangle_vertices = vertices.reshape(-1, 3)
+    best = int(np.argmax(valence_scores[valence][triangle_vertices].sum(axis=1)))
+    triangle_vertices = triangle_vertices.tolist()
+    valence_scores = valence_scores.tolist()
+    vertex_scores = [valence_scores[count] for count in valence.tolist()]
+    emitted = [False] * num_faces
+    order = []
+    cache = []
+    next_unemitted = 0
+
+    while True:
+        order.append(best)
+        emitted[best] = True
+        triangle = triangle_vertices[best]
+        for vertex in triangle:
+            adjacency[vertex].remove(best)
+        # Repeated corners only take one cache entry
+        added = list(dict.fromkeys(triangle))
+        cache = added + [vertex for vertex in cache if vertex not in added]
+
+        # Rescore everything touched by the cache
+        for vertex in cache[VERTEX_CACHE_SIZE:]:
+            triangles = adjacency[vertex]
+            vertex_scores[vertex] = valence_scores[len(triangles)] if triangles else -1.0
+        del cache[VERTEX_CACHE_SIZE:]
+        for position, vertex in enumerate(cache):
+            triangles = adjacency[vertex]
+            if triangles:
+                vertex_scores[vertex] = cache_scores[position + 1] + valence_scores[len(triangles)]
+            else:
+                vertex_scores[vertex] = -1.0
+
+        # Best triangle in the cache, or the next unemitted one
+        best = -1
+        best_score = -1.0
+        for vertex in cache:
+            for candidate in adjacency[vertex]:
+                a, b, c = triangle_vertices[candidate]
+                score = vertex_scores[a] + vertex_scores[b] + vertex_scores[c]
+                if score > best_score:
+                    best = candidate
+                    best_score = score
+        if best < 0:
+            while next_unemitted < num_faces and emitted[next_unemitted]:
+                next_unemitted += 1
+            if next_unemitted == num_faces:
+                break
+            best = next_unemitted
+
+    return np.array(order, dtype=np.int64)
+
+def first_use_order(indices, count):
+    # Renumbers indices in order of their first use, unused entries go last
+    indices = np.asarray(indices).ravel()
+    _, first = np.unique(indices, return_index=True)
+    used = indices[np.sort(first)]
+    unused = np.setdiff1d(np.arange(count), used)
+    old_order = np.concatenate((used, unused)).astype(np.int64)
+    remap = np.empty(count, dtype=np.int64)
+    remap[old_order] = np.arange(count)
+    return old_order, remap
+
+def drop_degenerate_faces(position_indices, tc_indices, materials):
+    # Welding can collapse triangles to a line or a point. Drops them and
+    # the vertices and tcs only they used. Returns the kept faces, the
+    # remaining vertices and tcs as indices into the old ones, and the
+    # number of dropped faces
+    keep = ((position_indices[:, 0] != position_indices[:, 1]) &
+            (position_indices[:, 1] != position_indices[:, 2]) &
+            (position_indices[:, 2] != position_indices[:, 0]))
+    used_positions, position_indices = np.unique(position_indices[keep], return_inverse=True)
+    used_tcs, tc_indices = np.unique(tc_indices[keep], return_inverse=True)
+    return (position_indices.reshape(-1, 3), tc_indices.reshape(-1, 3), materials[keep],
+            used_positions, used_tcs, int(len(keep) - keep.sum()))
+
+def weld_points(points, tolerance):
+    # Clusters points that are closer than the tolerance using a spatial
+    # hash grid. Every point joins the first earlier cluster it finds in its
+    # own or a neighbouring cell. Clusters are numbered by first occurrence,
+    # returns the index of the first point of every cluster and the cluster
+    # of every point. A tolerance of zero only merges equal points
+    points = np.asarray(points, dtype=np.float64)
+    _, first, inverse = np.unique(points + 0.0, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    if tolerance <= 0.0:
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        return first[order], rank[inverse.reshape(-1)]
+    candidates = points[first[order]]
+    cells = np.floor(candidates / tolerance).astype(np.int64).tolist()
+    neighbours = list(product((-1, 0, 1), repeat=points.shape[1]))
+    tolerance_squared = tolerance * tolerance
+
+    grid = {}
+    representatives = []
+    clusters = [0] * len(candidates)
+    for i, (point, cell) in enumerate(zip(candidates.tolist(), cells)):
+        cluster = -1
+        for offset in neighbours:
+            for other, other_point in grid.get(tuple(c + o for c, o in zip(cell, offset)), ()):
+                if sum((a - b) * (a - b) for a, b in zip(point, other_point)) <= tolerance_squared:
+                    cluster = other
+                    break
+            if cluster >= 0:
+                break
+        if cluster < 0:
+            cluster = len(representatives)
+            representatives.append(i)
+            grid.setdefault(tuple(cell), []).append((cluster, point))
+        clusters[i] = cluster
+
+    unique_clusters = np.empty(len(candidates), dtype=np.int64)
+    unique_clusters[order] = clusters
+    return first[order][representatives], unique_clusters[inverse.reshape(-1)]
@@ -0,0 +1,130 @@
+# ##### BEGIN MIT LICENSE BLOCK #####
+#
+# Copyright (c) 2025 SomaZ
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# ##### END MIT LICENSE BLOCK #####
+
+# Copies sod files and every texture they use into the sod and textures
+# folders of a mod. A manifest of content hashes in the mod folder remembers
+# what was copied, so a rebuild only copies files that changed. Doesn't
+# need blender.
+
+import json
+import os
+import shutil
+from .SOD import SOD, hash_file
+
+MANIFEST_NAME = "manifest.json"
+# Same search order as the importer
+TEXTURE_FOLDERS = ("rgb/", "index8/", "dds/", "", "compressed/")
+TEXTURE_FORMATS = (".tga", ".dds")
+
+def get_texture_path(file_path):
+    # Textures folder next to the sod folder
+    split = file_path.replace("\\", "/").split("/sod/")
+    if len(split) > 1:
+        return split[0] + "/textures/"
+    return ""
+
+def get_file_entry(file_path, known):
+    # Hashing is skipped if size and modification time didn't change
+    status = os.stat(file_path)
+    if known and known["size"] == status.st_size and known["mtime"] == status.st_mtime_ns:
+        return dict(known)
+    return {"hash": hash_file(file_path), "size": status.st_size, "mtime": status.st_mtime_ns}
+
+def get_texture_names(file_path):
+    # Main, bumpmap and assimilation textures of every mesh
+    sod = SOD.from_file_path(file_path)
+    names = set()
+    for node in sod.nodes.values():
+        if node.mesh is None:
+            continue
+        for name in (node.mesh.texture, node.mesh.bumpmap, node.mesh.assimilation_texture):
+            if name:
+                names.add(name)
+    return sorted(names)
+
+def find_texture(name, texture_path):
+    for folder in TEXTURE_FOLDERS:
+        for fmt in TEXTURE_FORMATS:
+            relative_path = folder + name + fmt
+            if os.path.isfile(os.path.join(texture_path, relative_path)):
+                return relative_path
+    return None
+
+def copy_if_changed(source_path, target_path, entry, known):
+    if known and known["hash"] == entry["hash"] and os.path.isfile(target_path):
+        return False
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    shutil.copyfile(source_path, target_path)
+    return True
+
+def load_manifest(mod_path):
+    try:
+        with open(os.path.join(mod_path, MANIFEST_NAME), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"sod": {}, "textures": {}}
+
+def package_mod(sod_files, mod_path, texture_path=""):
+    # Textures are looked up in the texture path, or in the textures folder
+    # next to the sod folder of every file. Returns what was copied and the
+    # names of textures that weren't found
+    old_manifest = load_manifest(mod_path)
+    manifest = {"sod": {}, "textures": {}}
+    result = {"copied_sod": [], "copied_textures": [], "missing_textures": []}
+
+    for file_path in sorted(sod_files):
+        name = os.path.basename(file_path)
+        known = old_manifest["sod"].get(name)
+        entry = get_file_entry(file_path, known)
+        if known and known["hash"] == entry["hash"]:
+            texture_names = known["texture_names"]
+        else:
+            texture_names = get_texture_names(file_path)
+        entry["texture_names"] = texture_names
+        manifest["sod"][name] = entry
+        if copy_if_changed(file_path, os.path.join(mod_path, "sod", name), entry, known):
+            result["copied_sod"].append(name)
+
+        search_path = texture_path or get_texture_path(file_path)
+        for texture_name in texture_names:
+            relative_path = find_texture(texture_name, search_path) if search_path else None
+            if relative_path is None:
+                if texture_name not in result["missing_textures"]:
+                    result["missing_textures"].append(texture_name)
+                continue
+            if relative_path in manifest["textures"]:
+                continue
+            source_path = os.path.join(search_path, relative_path)
+            known = old_manifest["textures"].get(relative_path)
+            entry = get_file_entry(source_path, known)
+            manifest["textures"][relative_path] = entry
+            if copy_if_changed(source_path, os.path.join(mod_path, "textures", relative_path), entry, known):
+                result["copied_textures"].append(relative_path)
+
+    os.makedirs(mod_path, exist_ok=True)
+    with open(os.path.join(mod_path, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    result["sod"] = len(manifest["sod"])
+    result["textures"] = len(manifest["textures"])
+    return result
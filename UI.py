@@ -1,12 +1,86 @@
 import bpy
 import os, uuid
+import cProfile
+import logging
+import pstats
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
 from bpy_extras.io_utils import ImportHelper, ExportHelper
-from bpy.props import StringProperty, BoolProperty, EnumProperty, IntProperty
+from bpy.props import StringProperty, BoolProperty, EnumProperty, IntProperty, FloatProperty
 from bpy.types import PropertyGroup
 from .SOD import SOD
 from . import Blender_SOD
 from . import Blender_Materials
 
+log = logging.getLogger(__name__)
+
+
+def get_preferences():
+    return bpy.context.preferences.addons[__name__.split('.')[0]].preferences
+
+
+def get_profile_path(prefs):
+    if prefs.profile_path != "":
+        return bpy.path.abspath(prefs.profile_path)
+    return os.path.join(tempfile.gettempdir(), "sta_last_operation.pstats")
+
+
+class Operation_profiler:
+    # Collects the profiles of every part of an operation, also from several
+    # modal steps and threads, if enabled in the preferences. The next
+    # operation overwrites the dumped pstats
+    def __init__(self, name):
+        self.name = name
+        self.prefs = get_preferences()
+        self.profiles = []
+
+    @contextmanager
+    def profile(self):
+        # Profiles the calling thread while inside
+        if not self.prefs.profile:
+            yield
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Newer Pythons only allow one active profiler at a time
+            log.debug("Another profiler is active, %s is only partly profiled", self.name)
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.profiles.append(profiler)
+
+    def dump(self):
+        if not self.profiles:
+            return
+        stats = pstats.Stats(self.profiles[0])
+        for profiler in self.profiles[1:]:
+            stats.add(profiler)
+        profile_path = get_profile_path(self.prefs)
+        stats.dump_stats(profile_path)
+        log.info("Profile of %s written to %s", self.name, profile_path)
+        self.profiles = []
+
+
+@contextmanager
+def profile_operation(name):
+    profiler = Operation_profiler(name)
+    try:
+        with profiler.profile():
+            yield
+    finally:
+        profiler.dump()
+
+
+def format_timings(timings):
+    return ", ".join("{} {:.3f}s".format(phase, seconds) for phase, seconds in timings.items())
+
 
 def guess_texture_path(file_path):
     SPLIT_FOLDER = "/sod/"
@@ -37,25 +111,286 @@ class Import_STA_SOD(bpy.types.Operator, ImportHelper):
         description="File path used for importing the SOD file",
         maxlen=1024,
         default="")
+    reuse_meshes: BoolProperty(
+        name="Reuse identical meshes",
+        description="Share mesh data between nodes with identical geometry and materials, "
+                    "also across multiple imports",
+        default=True)
+    merge_meshes: BoolProperty(
+        name="Merge static meshes",
+        description="Import all static mesh nodes as one object for better viewport performance. "
+                    "The nodes are split again on export",
+        default=False)
+    point_nodes: BoolProperty(
+        name="Hardpoints as points",
+        description="Import leaf nodes below Hardpoints, Lights and Damage as points of "
+                    "one object per parent instead of individual empties",
+        default=False)
+    reduce_keyframes: BoolProperty(
+        name="Reduce keyframes",
+        description="Only keep keyframes that linear interpolation can't reproduce",
+        default=False)
+    keyframe_tolerance: FloatProperty(
+        name="Keyframe tolerance",
+        description="Maximum allowed difference between the sampled and the interpolated animation",
+        default=0.0001,
+        min=0.0,
+        precision=5)
+    show_progress: BoolProperty(
+        name="Show progress",
+        description="Read the file in the background and build the scene in small steps. "
+                    "Esc cancels and removes everything imported so far",
+        default=False)
 
     def execute(self, context):
         sanitized_filepath = self.filepath.replace("\\", "/")
+        if self.show_progress and not bpy.app.background:
+            return self.start_modal_import(context, sanitized_filepath)
         context.scene.sta_sod_file_path = sanitized_filepath
 
+        stats = {}
+        with profile_operation("import"):
+            try:
+                start = time.perf_counter()
+                sod = SOD.from_file_path(sanitized_filepath)
+                Blender_SOD.Add_timing(stats, "parse", start)
+            except Exception as e:
+                log.error(e)
+                self.report({"ERROR"}, str(e))
+                return {'CANCELLED'}
+            mesh_objects = Blender_SOD.Import_SOD(
+                sod, self.reuse_meshes, stats, self.merge_meshes, self.point_nodes,
+                self.keyframe_tolerance if self.reduce_keyframes else 0.0)
+            texture_path = guess_texture_path(sanitized_filepath.lower())
+            Blender_Materials.finsh_object_materials(mesh_objects, texture_path, sod.materials, stats)
+        self.report_stats(stats, mesh_objects)
+        return {'FINISHED'}
+
+    def start_modal_import(self, context, file_path):
+        self._file_path = file_path
+        self._sod = None
+        self._error = None
+        self._steps = None
+        self._materials = None
+        self._stats = {}
+        self._profiler = Operation_profiler("import")
+
+        def parse():
+            try:
+                with self._profiler.profile():
+                    start = time.perf_counter()
+                    self._sod = SOD.from_file_path(file_path)
+                    Blender_SOD.Add_timing(self._stats, "parse", start)
+            except Exception as e:
+                self._error = e
+
+        self._thread = threading.Thread(target=parse, daemon=True)
+        self._thread.start()
+        window_manager = context.window_manager
+        self._timer = window_manager.event_timer_add(0.05, window=context.window)
+        window_manager.progress_begin(0, 100)
+        window_manager.modal_handler_add(self)
+        context.workspace.status_text_set("Reading {}, Esc to cancel".format(os.path.basename(file_path)))
+        return {'RUNNING_MODAL'}
+
+    def end_modal_import(self, context):
+        context.window_manager.event_timer_remove(self._timer)
+        context.window_manager.progress_end()
+        context.workspace.status_text_set(None)
+
+    def cancel_modal_import(self, context, message):
+        # Removes everything the import created so far
+        if self._steps is not None:
+            self._steps.close()
+            Blender_SOD.Remove_new_data(self._snapshot)
+            context.scene.frame_start, context.scene.frame_end = self._frame_range
+        self.end_modal_import(context)
+        self.report({"WARNING"} if self._error is None else {"ERROR"}, message)
+        return {'CANCELLED'}
+
+    def modal(self, context, event):
+        with self._profiler.profile():
+            result = self.step_modal_import(context, event)
+        if result != {'RUNNING_MODAL'}:
+            self._profiler.dump()
+        return result
+
+    def step_modal_import(self, context, event):
+        if event.type == 'ESC':
+            return self.cancel_modal_import(context, "Import cancelled")
+        if event.type != 'TIMER':
+            return {'RUNNING_MODAL'}
+
+        if self._steps is None:
+            if self._thread.is_alive():
+                return {'RUNNING_MODAL'}
+            if self._error is not None:
+                log.error(self._error)
+                return self.cancel_modal_import(context, str(self._error))
+            self._snapshot = Blender_SOD.Get_data_snapshot()
+            self._frame_range = (context.scene.frame_start, context.scene.frame_end)
+            self._steps = Blender_SOD.Import_SOD_steps(
+                self._sod, self.reuse_meshes, self._stats, self.merge_meshes, self.point_nodes,
+                self.keyframe_tolerance if self.reduce_keyframes else 0.0)
+
+        # Build for a short time, then give the interface a chance to redraw
+        deadline = time.perf_counter() + 0.05
+        try:
+            while time.perf_counter() < deadline:
+                if self._materials is None:
+                    try:
+                        step, total_steps = next(self._steps)
+                    except StopIteration as finished:
+                        self._mesh_objects = finished.value
+                        self._materials = list(dict.fromkeys(
+                            mat for obj in self._mesh_objects for mat in obj.data.materials))
+                        self._texture_path = guess_texture_path(self._file_path.lower())
+                        continue
+                    context.window_manager.progress_update(100 * step // max(total_steps, 1))
+                    context.workspace.status_text_set("Importing node {} of {}, Esc to cancel".format(
+                        step, total_steps))
+                elif len(self._materials):
+                    start = time.perf_counter()
+                    Blender_Materials.finish_mat(
+                        self._materials.pop(), self._texture_path, self._sod.materials, stats=self._stats)
+                    Blender_SOD.Add_timing(self._stats, "materials", start)
+                    context.workspace.status_text_set("Setting up materials, {} left, Esc to cancel".format(
+                        len(self._materials)))
+                else:
+                    break
+            else:
+                return {'RUNNING_MODAL'}
+        except Exception as e:
+            log.error(e)
+            self._error = e
+            return self.cancel_modal_import(context, str(e))
+
+        self.end_modal_import(context)
+        context.scene.sta_sod_file_path = self._file_path
+        self.report_stats(self._stats, self._mesh_objects)
+        return {'FINISHED'}
+
+    def report_stats(self, stats, mesh_objects):
+        if stats["reused_meshes"]:
+            self.report({"INFO"}, "Reused {} of {} mesh datablocks".format(
+                stats["reused_meshes"], len(mesh_objects)))
+        if stats.get("point_nodes"):
+            self.report({"INFO"}, "Imported {} nodes as points".format(stats["point_nodes"]))
+        if self.reduce_keyframes and stats["animation_keys"]:
+            self.report({"INFO"}, "Kept {} of {} keyframes ({:.1f}%)".format(
+                stats["written_keys"], stats["animation_keys"],
+                100.0 * stats["written_keys"] / stats["animation_keys"]))
+        if stats.get("timings"):
+            self.report({"INFO"}, "Import: " + format_timings(stats["timings"]))
+
+
+class STA_OP_Reload_SOD(bpy.types.Operator):
+    """Reload the last imported sod file and only update the nodes that changed"""
+    bl_idname = "sta.reload_sod"
+    bl_label = "Reload SOD from disk"
+    bl_options = {"UNDO", "REGISTER"}
+
+    reduce_keyframes: BoolProperty(
+        name="Reduce keyframes",
+        description="Only keep keyframes that linear interpolation can't reproduce",
+        default=False)
+    keyframe_tolerance: FloatProperty(
+        name="Keyframe tolerance",
+        description="Maximum allowed difference between the sampled and the interpolated animation",
+        default=0.0001,
+        min=0.0,
+        precision=5)
+
+    def execute(self, context):
+        file_path = context.scene.sta_sod_file_path
+        if file_path == "":
+            self.report({"ERROR"}, "No sod file was imported yet")
+            return {'CANCELLED'}
+
         try:
-            sod = SOD.from_file_path(sanitized_filepath)
+            sod = SOD.from_file_path(file_path)
         except Exception as e:
-            print(e)
+            log.error(e)
             self.report({"ERROR"}, str(e))
             return {'CANCELLED'}
-        mesh_objects = Blender_SOD.Import_SOD(sod)
-        texture_path = guess_texture_path(sanitized_filepath.lower())
-        Blender_Materials.finsh_object_materials(mesh_objects, texture_path, sod.materials)
-        
+
+        stats = {}
+        mesh_objects = Blender_SOD.Reload_SOD(
+            sod, self.keyframe_tolerance if self.reduce_keyframes else 0.0, stats)
+
+        # Only set up materials that were created by the reload
+        texture_path = guess_texture_path(file_path.lower())
+        materials = set()
+        for obj in mesh_objects:
+            for mat in obj.data.materials:
+                if mat is not None and not mat.use_nodes:
+                    materials.add(mat)
+        for mat in materials:
+            Blender_Materials.finish_mat(mat, texture_path, sod.materials)
+
+        self.report({"INFO"}, "Updated {} meshes, {} nodes, {} animations. Added {}, removed {} nodes".format(
+            stats["updated_meshes"], stats["updated_nodes"], stats["updated_animations"],
+            stats["added_nodes"], stats["removed_nodes"]))
         return {'FINISHED'}
 
 
-class Export_STA_SOD(bpy.types.Operator, ExportHelper):
+class STA_Export_Properties:
+    # Options shared by the export operators
+    version: EnumProperty(
+        name="Game",
+        description="Export for Armada or Armada II",
+        default='1.8',
+        items=[
+            ('1.8', "Star Trek: Armada",
+             "Exports SOD version 1.8", 0),
+            ('1.93', "Star Trek: Armada II",
+             "Exports SOD version 1.93", 1),
+            ('BOTH', "Both games",
+             "Exports SOD version 1.8 and a 1.93 copy next to it", 2),
+        ])
+    armada2_suffix: StringProperty(
+        name="Armada II suffix",
+        description="Added to the file name of the Armada II copy when exporting for both games",
+        default="_a2")
+    optimize_vertex_cache: BoolProperty(
+        name="Optimize vertex cache",
+        description="Reorder the faces of every material group for better vertex cache reuse",
+        default=False)
+    renumber_vertices: BoolProperty(
+        name="Renumber vertices",
+        description="Reorder vertices and texture coordinates by their first use in the face list",
+        default=False)
+    merge_children: BoolProperty(
+        name="Merge static children",
+        description="Bake non animated mesh children with the same material type, texture and culling into their parent node",
+        default=False)
+    weld_vertices: BoolProperty(
+        name="Weld vertices",
+        description="Merge vertices and texture coordinates closer than the weld tolerance, ignoring normals",
+        default=False)
+    weld_tolerance: FloatProperty(
+        name="Weld tolerance",
+        description="Maximum distance between merged vertices and texture coordinates",
+        default=0.0001,
+        min=0.000001,
+        precision=5)
+    splice: BoolProperty(
+        name="Reuse unchanged meshes",
+        description="Copy the meshes of unchanged nodes from the file that is overwritten instead of building them again. "
+                    "Keeps a .hashes file next to the sod",
+        default=False)
+
+    def get_export_options(self):
+        return Blender_SOD.Export_options(
+            optimize_vertex_cache=self.optimize_vertex_cache,
+            renumber_vertices=self.renumber_vertices,
+            weld_vertices=self.weld_vertices,
+            weld_tolerance=self.weld_tolerance,
+            merge_children=self.merge_children,
+            splice=self.splice)
+
+
+class Export_STA_SOD(bpy.types.Operator, ExportHelper, STA_Export_Properties):
     """Export a Star Trek Armada (I or II) sod file"""
     bl_idname = "export_scene.sta_sod"
     bl_label = "Export Star Trek Armada SOD (.sod)"
@@ -67,32 +402,224 @@ class Export_STA_SOD(bpy.types.Operator, ExportHelper):
         description="File path used for exporting the SOD file",
         maxlen=1024,
         default="")
+    background: BoolProperty(
+        name="Export in background",
+        description="Keep working while the meshes are built and the file is written. Press Esc to cancel",
+        default=False)
+
+    def execute(self, context):
+        options = self.get_export_options()
+        if self.version == 'BOTH':
+            base_path, extension = os.path.splitext(self.filepath)
+            targets = [(self.filepath, 1.8), (base_path + self.armada2_suffix + extension, 1.93)]
+        else:
+            targets = [(self.filepath, float(self.version))]
+        if self.background:
+            return self.start_background_export(context, targets, options)
+
+        try:
+            with profile_operation("export"):
+                Blender_SOD.Export_SOD_targets(targets, options)
+        except Exception as e:
+            log.error(e)
+            self.report({"ERROR"}, str(e))
+            return {'CANCELLED'}
+
+        self.report_stats(options.stats)
+        return {'FINISHED'}
+
+    def start_background_export(self, context, targets, options):
+        # Blender data is gathered right away, building the meshes and
+        # writing the files continues on a worker thread
+        self._profiler = Operation_profiler("export")
+        try:
+            with self._profiler.profile():
+                export_job = Blender_SOD.Start_export_targets(targets, options)
+        except Exception as e:
+            log.error(e)
+            self.report({"ERROR"}, str(e))
+            self._profiler.dump()
+            return {'CANCELLED'}
+
+        self._options = options
+        self._mesh_builder = export_job[1]
+        self._error = None
+
+        def finish_export():
+            try:
+                with self._profiler.profile():
+                    Blender_SOD.Finish_export_targets(*export_job, targets, options)
+            except Exception as e:
+                self._error = e
+
+        self._thread = threading.Thread(target=finish_export, daemon=True)
+        self._thread.start()
+        window_manager = context.window_manager
+        self._timer = window_manager.event_timer_add(0.1, window=context.window)
+        window_manager.progress_begin(0, 100)
+        window_manager.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self._options.cancel.set()
+            return {'RUNNING_MODAL'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        done, total = self._mesh_builder.progress()
+        if self._thread.is_alive():
+            if total:
+                context.window_manager.progress_update(100 * done // total)
+            context.workspace.status_text_set("Exporting SOD: {} of {} meshes built, Esc to cancel".format(
+                done, total) if total else "Writing SOD, Esc to cancel")
+            return {'PASS_THROUGH'}
+
+        context.window_manager.event_timer_remove(self._timer)
+        context.window_manager.progress_end()
+        context.workspace.status_text_set(None)
+        self._profiler.dump()
+        if isinstance(self._error, Blender_SOD.Export_cancelled):
+            self.report({"WARNING"}, "Export cancelled")
+            return {'CANCELLED'}
+        if self._error is not None:
+            log.error(self._error)
+            self.report({"ERROR"}, str(self._error))
+            return {'CANCELLED'}
+        self.report({"INFO"}, "Finished exporting {}".format(self.filepath))
+        self.report_stats(self._options.stats)
+        return {'FINISHED'}
+
+    def report_stats(self, stats):
+        if self.optimize_vertex_cache and stats.get("acmr_triangles"):
+            self.report({"INFO"}, "Average cache miss ratio {:.3f} -> {:.3f}".format(
+                stats["acmr_before"] / stats["acmr_triangles"],
+                stats["acmr_after"] / stats["acmr_triangles"]))
+        if stats.get("peak_memory"):
+            self.report({"INFO"}, "Export peak memory {:.1f} MB".format(stats["peak_memory"] / (1024 * 1024)))
+        if stats.get("merged_children"):
+            self.report({"INFO"}, "Merged {} static mesh children into their parents".format(
+                stats["merged_children"]))
+        if stats.get("cached_meshes"):
+            self.report({"INFO"}, "Reused {} unchanged meshes from earlier exports".format(
+                stats["cached_meshes"]))
+        if stats.get("spliced_meshes"):
+            self.report({"INFO"}, "Copied {} unchanged meshes from the old file".format(
+                stats["spliced_meshes"]))
+        if stats.get("evaluated_animations") or stats.get("sampled_animations"):
+            self.report({"INFO"}, "Evaluated {} animations from f-curves, sampled {} over {} frames".format(
+                stats["evaluated_animations"], stats["sampled_animations"], stats["sampled_frames"]))
+        for node_name, (verts, tcs) in stats.get("welded", {}).items():
+            if verts or tcs:
+                self.report({"INFO"}, "{}: welded {} vertices and {} texture coordinates".format(
+                    node_name, verts, tcs))
+        if stats.get("degenerate_faces"):
+            self.report({"INFO"}, "Dropped {} faces collapsed by welding".format(stats["degenerate_faces"]))
+        if stats.get("timings"):
+            self.report({"INFO"}, "Export: " + format_timings(stats["timings"]))
+        
+    def invoke(self, context, event): # type: ignore
+        prefs = bpy.context.preferences.addons[__name__.split('.')[0]].preferences
+        self.version = prefs.default_export_game
+        return super().invoke(context, event)
+
+
+class Export_STA_SOD_Batch(bpy.types.Operator, STA_Export_Properties):
+    """Export every scene and collection with a root object to its own sod file"""
+    bl_idname = "export_scene.sta_sod_batch"
+    bl_label = "Export Star Trek Armada SODs (batch)"
+
+    directory: StringProperty(
+        name="Folder",
+        description="Folder the sod files are written to",
+        subtype='DIR_PATH')
+
+    def execute(self, context):
+        exports = Blender_SOD.Get_batch_exports()
+        if not exports:
+            self.report({"ERROR"}, "No scene or collection with a 'root' or 'Scene Root' object found")
+            return {'CANCELLED'}
+
+        options = self.get_export_options()
+        batch = [(scene, root, get_batch_targets(self.directory, name, self.version, self.armada2_suffix))
+                 for name, scene, root in exports]
+
+        start = time.perf_counter()
+        with profile_operation("batch export"):
+            errors = Blender_SOD.Export_SOD_batch(batch, options)
+        for (name, _, _), error in zip(exports, errors):
+            if error is not None:
+                log.error("%s: %s", name, error)
+                self.report({"WARNING"}, "{}: {}".format(name, error))
+        exported = errors.count(None)
+        self.report({"INFO"}, "Exported {} of {} ships in {:.2f}s".format(
+            exported, len(exports), time.perf_counter() - start))
+        if options.stats.get("cached_meshes"):
+            self.report({"INFO"}, "Reused {} meshes shared between ships or unchanged since earlier exports".format(
+                options.stats["cached_meshes"]))
+        if options.stats.get("spliced_meshes"):
+            self.report({"INFO"}, "Copied {} unchanged meshes from the old files".format(
+                options.stats["spliced_meshes"]))
+        if options.stats.get("timings"):
+            self.report({"INFO"}, "Export: " + format_timings(options.stats["timings"]))
+        return {'FINISHED'} if exported else {'CANCELLED'}
+
+    def invoke(self, context, event):
+        prefs = bpy.context.preferences.addons[__name__.split('.')[0]].preferences
+        self.version = prefs.default_export_game
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+
+def get_batch_targets(directory, name, version, armada2_suffix):
+    file_path = os.path.join(directory, name + ".sod")
+    if version == 'BOTH':
+        return [(file_path, 1.8), (os.path.join(directory, name + armada2_suffix + ".sod"), 1.93)]
+    return [(file_path, float(version))]
+
+
+class STA_OP_Analyze_Export(bpy.types.Operator):
+    """Run the export without writing a file and report how close every mesh node is to the sod limits"""
+    bl_idname = "sta.analyze_export"
+    bl_label = "Analyze export budget"
+    bl_options = {"REGISTER"}
+
     version: EnumProperty(
         name="Game",
-        description="Export for Armada or Armada II",
+        description="Analyze for Armada or Armada II",
         default='1.8',
         items=[
             ('1.8', "Star Trek: Armada",
-             "Exports SOD version 1.8", 0),
+             "Analyzes SOD version 1.8", 0),
             ('1.93', "Star Trek: Armada II",
-             "Exports SOD version 1.93", 1),
+             "Analyzes SOD version 1.93", 1),
         ])
 
     def execute(self, context):
-
         try:
-            Blender_SOD.Export_SOD(self.filepath, float(self.version))
+            with profile_operation("analysis"):
+                analysis = Blender_SOD.Analyze_SOD(float(self.version))
         except Exception as e:
-            print(e)
+            log.error(e)
             self.report({"ERROR"}, str(e))
             return {'CANCELLED'}
 
+        for line in Blender_SOD.Format_analysis(analysis):
+            log.info(line)
+        for row in analysis["nodes"]:
+            if row["usage"] > 0.9:
+                self.report({"WARNING"}, "{} uses {:.0f}% of the sod limits".format(
+                    row["name"], 100.0 * row["usage"]))
+        totals = analysis["totals"]
+        self.report({"INFO"}, "{} mesh nodes, {} vertices, {} faces, {} draw calls, {} bytes in {:.2f}s".format(
+            totals["mesh_nodes"], totals["verts"], totals["faces"], totals["draw_calls"],
+            totals["file_size"], sum(analysis["timings"].values())))
         return {'FINISHED'}
-        
-    def invoke(self, context, event): # type: ignore
+
+    def invoke(self, context, event):
         prefs = bpy.context.preferences.addons[__name__.split('.')[0]].preferences
         self.version = prefs.default_export_game
-        return super().invoke(context, event)
+        return self.execute(context)
 
 
 def menu_func_sod_import(self, context):
@@ -101,10 +628,11 @@ def menu_func_sod_import(self, context):
 
 def menu_func_sod_export(self, context):
     self.layout.operator(Export_STA_SOD.bl_idname, text="ST:Armada (.sod)")
+    self.layout.operator(Export_STA_SOD_Batch.bl_idname, text="ST:Armada batch (.sod)")
 
 
 def update_animated(self, context):
-    obj = context.active_object
+    obj = self.id_data
     if self.animated:
         if "start_frame" not in obj:
             obj["start_frame"] = 1
@@ -122,7 +650,7 @@ def update_animated(self, context):
 
 
 def update_texture_animation(self, context):
-    obj = context.active_object
+    obj = self.id_data
     if self.texture_animated:
         if "ref_animation" not in obj:
             obj["ref_animation"] = ""
@@ -232,11 +760,11 @@ class STA_OP_UpdateMaterial(bpy.types.Operator):
         mat = context.material
 
         if not mat.use_nodes:
-            print("No nodes in material found")
+            log.warning("No nodes in material found")
             return {'CANCELLED'}
         
         if "ST:A Material" not in mat.node_tree.nodes:
-            print("No ST:A Material found")
+            log.warning("No ST:A Material found")
             return {'CANCELLED'}
         
         if obj.sta_dynamic_props.texture_name == "":
@@ -422,6 +950,44 @@ class STA_OP_ChangeNodeType(bpy.types.Operator):
         return {'FINISHED'}
     
 
+class STA_OP_Generate_LODs(bpy.types.Operator):
+    """Puts the selected mesh nodes under a LOD control node together with decimated copies of them"""
+    bl_idname = "sta.generate_lods"
+    bl_label = "Generate LODs"
+    bl_options = {"UNDO", "REGISTER"}
+
+    levels: IntProperty(
+        name="Levels",
+        description="Number of reduced levels of detail",
+        default=2,
+        min=1,
+        max=8)
+    ratio: FloatProperty(
+        name="Ratio",
+        description="Share of triangles every level keeps from the level before",
+        default=0.5,
+        min=0.01,
+        max=1.0)
+
+    @classmethod
+    def poll(cls, context):
+        obj = context.active_object
+        return obj is not None and obj.type == "MESH" and obj.parent is not None
+
+    def execute(self, context):
+        selected = [obj for obj in context.selected_objects
+                    if Blender_SOD.Is_mesh_node(obj) and obj.parent is not None]
+        # Copies of a selected parent already include its children
+        objects = [obj for obj in selected if obj.parent not in selected]
+        ratios = [self.ratio ** (level + 1) for level in range(self.levels)]
+        for obj in objects:
+            Blender_SOD.Make_lod_chain(obj, ratios)
+
+        self.report({"INFO"}, "Generated {} levels of detail for {} nodes".format(
+            self.levels, len(objects)))
+        return {'FINISHED'}
+
+
 def update_object_materials(obj, context):
     texture_path = guess_texture_path(context.scene.sta_sod_file_path.lower())
     materials = set()
@@ -587,6 +1153,7 @@ class STA_PT_EntityPanel(bpy.types.Panel):
         layout.prop(obj.sta_dynamic_props, "texture_name")
         layout.operator("sta.load_mesh_texture", text="Load new mesh texture", icon="TEXTURE").texture = "TEXTURE"
         layout.operator("sta.udpate_all_object_materials")
+        layout.operator("sta.generate_lods")
 
         layout.separator()
         layout.prop(obj.sta_dynamic_props, "texture_animated")
@@ -710,12 +1277,12 @@ class STA_OP_Create_default_rig(bpy.types.Operator):
         for p in parenting:
             if p not in context.scene.objects:
                 if p.lower() not in context.scene.objects:
-                    print("Couldn't find parent", p)
+                    log.warning("Couldn't find parent %s", p)
                     continue
                 context.scene.objects[p.lower()].name = p
             if parenting[p] not in context.scene.objects:
                 if parenting[p].lower() not in context.scene.objects:
-                    print("Couldn't find node to parent", parenting[p])
+                    log.warning("Couldn't find node to parent %s", parenting[p])
                     continue
                 context.scene.objects[parenting[p].lower()].name = parenting[p]
             context.scene.objects[p].parent = context.scene.objects[parenting[p]]
@@ -757,6 +1324,10 @@ class STA_PT_HelperPanel(bpy.types.Panel):
         if "root" not in context.scene.objects:
             layout.operator("sta.create_rig")
 
+        if context.scene.sta_sod_file_path != "":
+            layout.operator("sta.reload_sod", icon="FILE_REFRESH")
+        layout.operator("sta.analyze_export", icon="INFO")
+
         for node in STA_NODES[1:]:
             if node == "Damage" and node in context.scene.objects:
                 layout.label(text="Damage Nodes:")
@@ -833,7 +1404,7 @@ Warning: Currently opened file will be lost"""
             try:
                 sod = SOD.from_file_path(sod_file)
             except Exception as e:
-                print(e)
+                log.error("%s: %s", sod_file, e)
                 continue
             for node in sod.nodes.values():
                 if node.type == 12:
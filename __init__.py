@@ -28,11 +28,14 @@ bl_info = {
     "category": "Import-Export"
 }
 
+import logging
+
 if "bpy" in locals():
     # Just do all the reloading here
     import importlib
-    from . import SOD, Blender_SOD
+    from . import SOD, SOD_Mesh_Tools, Blender_SOD
     importlib.reload(SOD)
+    importlib.reload(SOD_Mesh_Tools)
     importlib.reload(Blender_SOD)
     from . import Blender_Material_Nodes
     importlib.reload(Blender_Material_Nodes)
@@ -44,6 +47,14 @@ else:
     import bpy
     from . import UI
 
+# Everything the addon logs goes through the logger of the package
+log = logging.getLogger(__name__)
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("ST:A %(levelname)s %(name)s: %(message)s"))
+
+def update_log_level(self, context):
+    log.setLevel(self.log_level)
+
 # ------------------------------------------------------------------------
 #    store properties in the user preferences
 # ------------------------------------------------------------------------
@@ -69,6 +80,32 @@ class STAAddonPreferences(bpy.types.AddonPreferences):
              "Default to SOD version 1.93", 1),
         ])
 
+    log_level: bpy.props.EnumProperty(
+        name="Log level",
+        description="Messages below this level are not shown in the console",
+        default='INFO',
+        items=[
+            ('DEBUG', "Debug", "Also show the time every import and export phase takes", 0),
+            ('INFO', "Info", "Show progress and warnings", 1),
+            ('WARNING', "Warning", "Only show warnings and errors", 2),
+            ('ERROR', "Error", "Only show errors", 3),
+        ],
+        update=update_log_level)
+
+    profile: bpy.props.BoolProperty(
+        name="Profile operations",
+        description="Run imports, exports and analyses under cProfile, including modal imports and background exports, "
+                    "and write the pstats of the last operation to the profile path",
+        default=False)
+
+    profile_path: bpy.props.StringProperty(
+        name="Profile path",
+        description="File for the pstats of the last operation, empty uses the temporary folder",
+        default="",
+        subtype="FILE_PATH",
+        maxlen=2048,
+    )
+
     def assetslibs_list_cb(self, context):
         if bpy.app.version >= (3, 0, 0):
             libs = context.preferences.filepaths.asset_libraries
@@ -89,6 +126,11 @@ class STAAddonPreferences(bpy.types.AddonPreferences):
         row.prop(self, "default_image_path")
         row = layout.row()
         row.prop(self, "default_export_game")
+        row = layout.row()
+        row.prop(self, "log_level")
+        row = layout.row()
+        row.prop(self, "profile")
+        row.prop(self, "profile_path", text="")
         if bpy.app.version < (3, 0, 0):
             return
         layout.separator()
@@ -102,12 +144,16 @@ classes = (UI.STA_OP_FillAssetLibrary,
            UI.STA_Dynamic_Node_Properties,
            UI.STA_II_Dynamic_Node_Properties,
            UI.Import_STA_SOD,
+           UI.STA_OP_Reload_SOD,
            UI.Export_STA_SOD,
+           UI.Export_STA_SOD_Batch,
+           UI.STA_OP_Analyze_Export,
            UI.STA_OP_UpdateMaterial,
            UI.STA_PT_Materialpanel,
            UI.STA_OP_UpdateObjectMaterials,
            UI.STA_OP_LoadMeshTexture,
            UI.STA_OP_ChangeNodeType,
+           UI.STA_OP_Generate_LODs,
            UI.STA_PT_EntityPanel,
            UI.STA_OP_Toggle_Material_Export,
            UI.STA_OP_Make_Material,
@@ -122,6 +168,11 @@ classes = (UI.STA_OP_FillAssetLibrary,
 def register():
     for cls in classes:
         bpy.utils.register_class(cls)
+    log.addHandler(log_handler)
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    if __name__ in bpy.context.preferences.addons:
+        log.setLevel(bpy.context.preferences.addons[__name__].preferences.log_level)
     bpy.types.TOPBAR_MT_file_import.append(UI.menu_func_sod_import)
     bpy.types.TOPBAR_MT_file_export.append(UI.menu_func_sod_export)
     bpy.types.Object.sta_dynamic_props = bpy.props.PointerProperty(
@@ -142,6 +193,7 @@ def unregister():
     del bpy.types.Object.sta_II_dynamic_props
     for cls in classes:
         bpy.utils.unregister_class(cls)
+    log.removeHandler(log_handler)
     
 
 if __name__ == "__main__":